@@ -6,7 +6,9 @@ Created on Wed Jun  8 13:21:04 2022
 """
 #Import libraries
 import os
+import time
 from functools import partial
+import numpy as np
 import tUbeNet_metrics as metrics
 
 # import required objects and fuctions from keras
@@ -14,7 +16,7 @@ from tensorflow.keras.models import Model
 # CNN layers
 from tensorflow.keras.layers import (
     Input, concatenate, Conv3D, MaxPooling3D, 
-    Conv3DTranspose, LeakyReLU, Dropout, Dense, Flatten, GroupNormalization)
+    Conv3DTranspose, LeakyReLU, Dropout, Dense, Flatten, GroupNormalization, GlobalMaxPooling3D)
 # opimiser
 from tensorflow.keras.optimizers import Adam
 
@@ -48,14 +50,22 @@ class AttnBlock(tf.keras.layers.Layer):
 		attn_map=self.map(dot_prod)
 		return attn_map*query
     
+class StridedMaxPool3D(tf.keras.layers.Layer):
+	"""2x2x2 max pooling written as the maximum of strided slices along each axis. 
+	Equivalent to MaxPooling3D, but uses only ops supported by the built-in TFLite runtime."""
+	def call (self, x):
+		x = tf.maximum(x[:, 0::2], x[:, 1::2])
+		x = tf.maximum(x[:, :, 0::2], x[:, :, 1::2])
+		return tf.maximum(x[:, :, :, 0::2], x[:, :, :, 1::2])
+    
 class EncodeBlock(tf.keras.layers.Layer):
-	def __init__(self, channels=32, alpha=0.2, dropout=0.3):
+	def __init__(self, channels=32, alpha=0.2, dropout=0.3, tflite_compatible=False):
 		super(EncodeBlock,self).__init__()
 		self.conv1 = Conv3D(channels, (3, 3, 3), activation= 'linear', padding='same', kernel_initializer='he_uniform')
 		self.conv2 = Conv3D(channels, (3, 3, 3), activation= 'linear', padding='same', kernel_initializer='he_uniform')
 		self.norm = GroupNormalization(groups=int(channels/4), axis=4)
 		self.lrelu = LeakyReLU(negative_slope=alpha)
-		self.pool = MaxPooling3D(pool_size=(2, 2, 2))
+		self.pool = StridedMaxPool3D() if tflite_compatible else MaxPooling3D(pool_size=(2, 2, 2))
 		self.dropout = Dropout(dropout)
 	def call (self, x):
 		conv1 = self.conv1(x)
@@ -131,14 +141,16 @@ class tUbeNet(tf.keras.Model):
         self.alpha=alpha
         self.attention=attention
         
-    def build_model(self, encoder_only=False):        
+    def build_model(self, encoder_only=False, tflite_compatible=False):        
         inputs = Input((*self.input_dims, 1))
-             
-        block1 = EncodeBlock(channels=32, alpha=self.alpha, dropout=self.dropout)(inputs)
-        block2 = EncodeBlock(channels=64, alpha=self.alpha, dropout=self.dropout)(block1)
-        block3 = EncodeBlock(channels=128, alpha=self.alpha, dropout=self.dropout)(block2)
-        block4 = EncodeBlock(channels=256, alpha=self.alpha, dropout=self.dropout)(block3)
-        block5 = EncodeBlock(channels=512, alpha=self.alpha, dropout=self.dropout)(block4)
+        
+        # tflite_compatible swaps MaxPooling3D (not a built-in TFLite op) for an equivalent layer - weights are unchanged
+        encode = partial(EncodeBlock, alpha=self.alpha, dropout=self.dropout, tflite_compatible=tflite_compatible)
+        block1 = encode(channels=32)(inputs)
+        block2 = encode(channels=64)(block1)
+        block3 = encode(channels=128)(block2)
+        block4 = encode(channels=256)(block3)
+        block5 = encode(channels=512)(block4)
         
         block6 = UBlock(channels=1024, alpha=self.alpha)(block5)
         
@@ -157,6 +169,98 @@ class tUbeNet(tf.keras.Model):
         model = Model(inputs=inputs, outputs=output) 
         return model
     
+    def build_screener(self, channels=(8, 16, 32, 64)):
+        """ Screening network
+        Small, shallow classifier scoring whether a window contains vessels, used to skip empty windows before 
+        they reach the full model (see predict_segmentation_dask and train_screener.py). Encoder blocks are 
+        followed by global max pooling, so the network accepts windows of any size.
+        Inputs:
+        channels = number of channels in each encoder block (tuple of ints, default (8, 16, 32, 64))
+        Outputs:
+        model = model returning softmax scores (N,2): probability of no vessels/vessels in each window
+        """
+        inputs = Input((None, None, None, 1))
+        x = inputs
+        for c in channels:
+            x = EncodeBlock(channels=c, alpha=self.alpha, dropout=self.dropout)(x)
+        x = GlobalMaxPooling3D()(x)
+        x = LeakyReLU(negative_slope=self.alpha)(Dense(channels[-1], kernel_initializer='he_uniform')(x))
+        output = Dense(2, activation='softmax')(x) #classifier
+        
+        model = Model(inputs=inputs, outputs=output)
+        return model
+    
+    def inference_function(self, model, batch_size=1, jit_compile=False):
+        """ Compiled inference step
+        Wraps a built model in a tf.function with a fixed (None, *input_dims, 1) input signature, so inference
+        avoids the per-call overhead of model.predict. The function is traced (and compiled) once here by 
+        running a warm-up batch, and the time taken is reported.
+        Inputs:
+        model = built model (e.g. from load_weights), with input_dims matching this tUbeNet
+        batch_size = size of the warm-up batch (int, default 1) - use the batch size used for inference
+        jit_compile = compile with XLA (bool, default False). XLA compiles for each batch size, so smaller 
+            batches are padded to batch_size
+        Outputs:
+        predict = function taking a batch of windows (N,Z,X,Y,1) and returning softmax predictions as a 
+            numpy array (N,Z,X,Y,C). Compile time (s) is stored as predict.compile_time
+        """
+        @tf.function(input_signature=[tf.TensorSpec((None, *self.input_dims, 1), tf.float32)], 
+                     jit_compile=jit_compile)
+        def step(x):
+            return model(x, training=False)
+        
+        def predict(batch):
+            n = batch.shape[0]
+            if jit_compile and n < batch_size:
+                batch = np.concatenate([batch, np.zeros((batch_size-n, *batch.shape[1:]), dtype=batch.dtype)])
+            return step(batch).numpy()[:n]
+        
+        # Warm up - trace and compile before the first real batch
+        t0 = time.perf_counter()
+        predict(np.zeros((batch_size, *self.input_dims, 1), dtype=np.float32))
+        predict.compile_time = time.perf_counter()-t0
+        predict.model = model # Model whose weights are used (e.g. to identify it, see model_hash)
+        print("Compiled inference function{} in {:.1f} s".format(" with XLA" if jit_compile else "", predict.compile_time))
+        return predict
+    
+    def export_tflite(self, model, filename, quantisation='dynamic', calibration_data=None):
+        """ TFLite export
+        Converts a built model to a TFLite file for CPU inference (see TFLiteModel), optionally with 
+        post-training quantisation
+        Inputs:
+        model = built model (e.g. from load_weights), with input_dims matching this tUbeNet
+        filename = path of the .tflite file to write
+        quantisation = 'dynamic' (int8 weights), 'int8' (int8 weights and activations, requires calibration_data), 
+            'float16' (float16 weights) or None (float32). int8 export is restricted to int8 builtin ops, so it 
+            fails on ops that cannot be quantised at all. The converter still keeps ops without int8 kernels 
+            (e.g. CONV_3D, which TFLite only runs in float) between quantise/dequantise ops - see tflite_op_summary
+        calibration_data = iterable of image windows (1,Z,X,Y,1) used to calibrate activation ranges for int8
+        Outputs:
+        filename = path of the written file
+        """
+        # Rebuild with TFLite compatible layers and copy weights across
+        export_model = self.build_model(tflite_compatible=True)
+        export_model.set_weights(model.get_weights())
+        
+        converter = tf.lite.TFLiteConverter.from_keras_model(export_model)
+        if quantisation is not None:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantisation == 'float16':
+            converter.target_spec.supported_types = [tf.float16]
+        elif quantisation == 'int8':
+            if calibration_data is None:
+                raise ValueError("calibration_data must be provided for int8 quantisation")
+            converter.representative_dataset = lambda: ([np.asarray(x, dtype=np.float32)] for x in calibration_data)
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        elif quantisation not in (None, 'dynamic'):
+            raise ValueError("quantisation must be 'dynamic', 'int8', 'float16' or None")
+        
+        t0 = time.perf_counter()
+        with open(filename, 'wb') as f:
+            f.write(converter.convert())
+        print("Exported TFLite model ({} quantisation) to {} in {:.1f} s".format(quantisation, filename, time.perf_counter()-t0))
+        return filename
+    
     def selectLoss(self, loss_name, class_weights=None):
         """select loss from custom losses"""
         if loss_name == 'WCCE':
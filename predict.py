@@ -9,10 +9,12 @@ Created on Wed Sep  3 16:22:26 2025
 #Import libraries
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' #Suppress info logs from tf 
-import pickle
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from model import tUbeNet
 import tUbeNet_functions as tube
-from tUbeNet_classes import DataDir
+from tUbeNet_classes import DataDir, DataHeader, TFLiteModel
 import argparse
 
 def main(args):
@@ -21,6 +23,15 @@ def main(args):
     volume_dims = args.volume_dims
     overlap = args.overlap
     n_classes = args.n_classes  #TO DO expand to handel multi-class case
+    batch_size = args.batch_size
+    pipeline = args.pipeline
+    n_readers = args.n_readers
+    queue_depth = args.queue_depth
+    
+    n_shards = args.n_shards
+    shard_id = args.shard_id
+    local_workers = args.local_workers
+    merge_only = args.merge_only
 
     preview = args.preview
     attention = args.attention
@@ -32,16 +43,21 @@ def main(args):
     
     #----------------------------------------------------------------------------------------------------------------------------------------------
     """ Create Data Directory"""
-    # Load data headers into a list
-    header_filenames=[f for f in os.listdir(data_headers) if os.path.isfile(os.path.join(data_headers, f))]
     headers = []
-    try:
-        for file in header_filenames: #Iterate through header files
-            file=os.path.join(data_headers,file)
-            with open(file, "rb") as f:
-                data_header = pickle.load(f) # Unpickle DataHeader object
-            headers.append(data_header) # Add to list of headers
-    except IndexError: print("Unable to load data header files from {}".format(data_headers))
+    if data_headers is not None:
+        # Load data headers from the catalogue (or pickled header files from earlier versions)
+        headers = tube.load_headers(data_headers)
+    else:
+        # Read TIFF images directly, without preprocessing
+        image_directory, image_filenames = tube.list_image_files(args.image_directory)
+        if image_directory is None: raise ValueError('Image directory could not be found')
+        for image_filename in image_filenames:
+            if not image_filename.lower().endswith(('.tif', '.tiff')):
+                continue
+            image_path = os.path.join(image_directory, image_filename)
+            image_dims = tube.open_image(image_path, intensity_range=(0, 1)).shape # Shape only
+            headers.append(DataHeader(ID=os.path.splitext(image_filename)[0], image_dims=image_dims, 
+                                      image_filename=image_path))
     
     # Create empty data directory    
     data_dir = DataDir([], image_dims=[], 
@@ -59,16 +75,62 @@ def main(args):
         data_dir.exclude_region.append((None,None,None)) #region to be left out of training for use as validation data (under development)
         
     
+    """ Choose inference window """
+    # tUbeNet is fully convolutional, so inference can use a larger window than training
+    if args.inference_dims is not None:
+        volume_dims = args.inference_dims
+        if not overlap:
+            # Small overlap, as planned for --memory_budget (half a large window would undo the saving)
+            overlap = tuple(int(round(d*tube.INFERENCE_OVERLAP_FRACTION)) for d in volume_dims)
+    elif args.memory_budget is not None:
+        # Largest window (and small overlap) that fits in the memory budget for the largest image
+        largest = max(data_dir.image_dims, key=lambda dims: dims[1]*dims[2])
+        volume_dims, planned_overlap = tube.plan_inference_window(args.memory_budget*1e9, image_shape=largest, 
+                                                                  n_classes=n_classes, batch_size=batch_size, 
+                                                                  queue_depth=queue_depth, min_dims=volume_dims)
+        if not overlap:
+            overlap = planned_overlap
+        print("Planned inference window {} with overlap {} for a {} GB memory budget".format(
+            volume_dims, overlap, args.memory_budget))
+    if any(d % 32 for d in volume_dims):
+        raise ValueError("Inference window {} must be a multiple of 32 on each axis".format(volume_dims))
+    
     """ Load Model """
-    # Initialise model
-    tubenet = tUbeNet(n_classes=n_classes, input_dims=volume_dims, attention=attention)
-    # Load weights
-    model = tubenet.load_weights(filename=model_path, loss='DICE CE')
+    model_args = (model_path, volume_dims, n_classes, attention, args.compiled, args.jit_compile, batch_size)
+    # In local sharded mode each worker process loads its own copy of the model instead
+    model = None
+    if n_shards == 1 or shard_id is not None:
+        model = load_model(*model_args)
     
     # If undefined set overlap to half volume_dims
     if not overlap:
         overlap = (volume_dims[0]//2,volume_dims[1]//2,volume_dims[2]//2)
     
+    # Inference settings shared by all images/shards
+    predict_kwargs = {'preview': preview,
+                      'batch_size': batch_size,
+                      'pipeline': pipeline,
+                      'n_readers': n_readers,
+                      'queue_depth': queue_depth,
+                      'background_threshold': args.background_threshold,
+                      'background_stat': args.background_stat,
+                      'resume': args.resume,
+                      'save_softmax': not args.binary_output,
+                      'softmax_dtype': args.softmax_dtype,
+                      'compressor': args.compressor,
+                      'compression_level': args.compression_level,
+                      'stitching': args.stitching,
+                      'intensity_range': args.intensity_range,
+                      'intensity_percentiles': args.intensity_percentiles,
+                      'screening_threshold': args.screening_threshold,
+                      'roi': args.roi_mask or args.roi,
+                      'roi_output': args.roi_output}
+    
+    # Optional screening network for two-stage (cascade) inference
+    screener = None
+    if args.screener_path is not None and (n_shards == 1 or shard_id is not None):
+        screener = load_screener(args.screener_path, volume_dims, batch_size)
+    
     """Predict segmentation"""
     for i in data_dir.image_filenames:
         # Isolate image filename
@@ -79,16 +141,90 @@ def main(args):
         dask_name = os.path.join(output_path,str(image_filename)+"_segmentation")
         if tiff_path: tiff_name=os.path.join(tiff_path,str(image_filename)+"_segmentation.tiff")
         else: tiff_name = None
-        tube.predict_segmentation_dask(
-            model,
-            i,                 
-            dask_name,                  
-            volume_dims=volume_dims,   
-            overlap=overlap,       
-            n_classes=n_classes,
-            export_bigtiff=tiff_name,
-            preview=preview   
-        )
+        
+        if args.incremental:
+            if n_shards > 1 or predict_kwargs['roi'] is not None:
+                raise ValueError("--incremental cannot be used with shards or a region of interest")
+            # Only windows reading changed image chunks are predicted again (everything on the first run)
+            kwargs = {k: v for k, v in predict_kwargs.items() if k not in ('roi', 'roi_output', 'resume')}
+            tube.update_segmentation_dask(model, i, dask_name, volume_dims=volume_dims, overlap=overlap, 
+                                          n_classes=n_classes, export_bigtiff=tiff_name, screener=screener, **kwargs)
+        elif n_shards > 1:
+            if predict_kwargs['roi'] is not None:
+                raise ValueError("Region of interest inference (--roi, --roi_mask) cannot be split into shards")
+            # Split image into shards listed in a manifest saved next to the output
+            manifest_path = tube.plan_inference_shards(i, dask_name, n_shards=n_shards, 
+                                                       volume_dims=volume_dims, overlap=overlap, 
+                                                       n_classes=n_classes, intensity_range=args.intensity_range,
+                                                       intensity_percentiles=args.intensity_percentiles)
+            if shard_id is not None:
+                # Run a single shard only (e.g. one task in a cluster job array) - merge separately with --merge_only
+                tube.run_inference_shard(model, manifest_path, shard_id, screener=screener, **predict_kwargs)
+                continue
+            if not merge_only:
+                run_local_shards(manifest_path, local_workers, 
+                                 model_args, predict_kwargs, screener_path=args.screener_path)
+            tube.merge_inference_shards(manifest_path, export_bigtiff=tiff_name)
+        else:
+            tube.predict_segmentation_dask(
+                model,
+                i,                 
+                dask_name,                  
+                volume_dims=volume_dims,   
+                overlap=overlap,       
+                n_classes=n_classes,
+                export_bigtiff=tiff_name,
+                screener=screener,
+                **predict_kwargs
+            )
+
+def load_model(model_path, volume_dims, n_classes, attention, compiled=False, jit_compile=False, batch_size=1):
+    """Initialise tUbeNet and load trained weights. 
+    If compiled, returns a compiled inference function (see tUbeNet.inference_function) instead of the model.
+    TFLite models (.tflite, see quantise.py) are loaded as a TFLiteModel backend"""
+    if str(model_path).endswith('.tflite'):
+        return TFLiteModel(model_path)
+    tubenet = tUbeNet(n_classes=n_classes, input_dims=volume_dims, attention=attention)
+    model = tubenet.load_weights(filename=model_path, loss='DICE CE')
+    if compiled or jit_compile:
+        return tubenet.inference_function(model, batch_size=batch_size, jit_compile=jit_compile)
+    return model
+
+def load_screener(screener_path, volume_dims=(64, 64, 64), batch_size=1):
+    """Build the screening network (see tUbeNet.build_screener) and load weights trained with train_screener.py.
+    Returns a compiled inference function, as the screener is called on every batch and is small enough that
+    the per-call overhead of model.predict would outweigh the time it saves"""
+    tubenet = tUbeNet(input_dims=volume_dims)
+    screener = tubenet.build_screener()
+    screener.load_weights(screener_path)
+    return tubenet.inference_function(screener, batch_size=batch_size)
+
+# Model (and optional screener) loaded once by each worker process in local sharded mode
+_worker_model = None
+_worker_screener = None
+
+def _init_shard_worker(model_args, screener_path=None):
+    global _worker_model, _worker_screener
+    _worker_model = load_model(*model_args)
+    if screener_path is not None:
+        _worker_screener = load_screener(screener_path, model_args[1], model_args[-1])
+
+def _run_shard_worker(manifest_path, shard_id, predict_kwargs):
+    tube.run_inference_shard(_worker_model, manifest_path, shard_id, screener=_worker_screener, **predict_kwargs)
+    return shard_id
+
+def run_local_shards(manifest_path, local_workers, model_args, predict_kwargs, screener_path=None):
+    """Run every shard in a manifest using a pool of local worker processes"""
+    with open(manifest_path, "r") as f:
+        n_shards = len(json.load(f)["shards"])
+    
+    # Spawn (rather than fork) workers so each initialises tensorflow cleanly
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=local_workers or n_shards, mp_context=context,
+                             initializer=_init_shard_worker, initargs=(model_args, screener_path)) as pool:
+        futures = [pool.submit(_run_shard_worker, manifest_path, k, predict_kwargs) for k in range(n_shards)]
+        for future in as_completed(futures):
+            print("Inference shard {} finished".format(future.result()))
 
 def parse_dims(values):
     """Parse volume dimensions: allow either one int (isotropic) or three ints (anisotropic)."""
@@ -104,10 +240,23 @@ def parse_dims(values):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run prediction using TubeNet model.")
 
-    parser.add_argument("--data_headers", type=str, required=True,
+    images = parser.add_mutually_exclusive_group(required=True)
+    images.add_argument("--data_headers", type=str,
                         help="Path to directory containing preprocessed header files.")
+    images.add_argument("--image_directory", type=str,
+                        help="Path to TIFF/OME-TIFF image file or directory, read directly without preprocessing.")
+    intensity = parser.add_mutually_exclusive_group()
+    intensity.add_argument("--intensity_range", type=float, nargs=2, default=None,
+                        help="Minimum and maximum intensity used to rescale TIFF images read with --image_directory. "
+                             "Found from each image if not given.")
+    intensity.add_argument("--intensity_header", type=str, default=None,
+                        help="Headers folder (or catalogue.json) from preprocessing.py. TIFF images read with --image_directory "
+                             "are rescaled with the same intensity range as the preprocessed data (e.g. the training data).")
+    parser.add_argument("--intensity_percentiles", type=float, nargs=2, default=[0, 100],
+                        help="Percentiles of image intensities used as the intensity range of TIFF images, if not "
+                             "given (e.g. 0.5 99.5, as used with preprocessing.py). Default: minimum and maximum.")
     parser.add_argument("--model_path", type=str, required=True,
-                        help="Path to trained model (.h5 file).")
+                        help="Path to trained model (.h5 file, or .tflite file exported with quantise.py).")
     parser.add_argument("--output_path", type=str, required=True,
                         help="Directory where predictions will be saved.")
     parser.add_argument("--tiff_path", type=str, default=None,
@@ -116,12 +265,78 @@ if __name__ == "__main__":
     parser.add_argument("--volume_dims", type=int, nargs="+", default=[64, 64, 64],
                         help="Volume dimensions passed to CNN. Provide 1 value (isotropic) "
                              "or 3 values (anisotropic). E.g. --volume_dims 64 OR --volume_dims 32 64 64")
+    parser.add_argument("--inference_dims", type=int, nargs="+", default=None,
+                        help="Window size used for inference, if larger than volume_dims (must be multiples of 32). "
+                             "Provide 1 value (isotropic) or 3 values (anisotropic). E.g. --inference_dims 160. "
+                             "Unless --overlap is given, the overlap is 10%% of the window.")
+    parser.add_argument("--memory_budget", type=float, default=None,
+                        help="RAM budget in GB. Picks the largest inference window (and a small overlap) that fits, "
+                             "unless --inference_dims is given.")
     parser.add_argument("--overlap", type=int, nargs="+", default=None,
                         help="Overlap between patches during inference. Provide 1 value (isotropic) "
                              "or 3 values (anisotropic). E.g. --overlap 32 OR --volume_dims 16 32 32. "
-                             "Defaults to half of volume_dims.")
+                             "Defaults to half of volume_dims, or 10%% of the window with --inference_dims/--memory_budget.")
+    parser.add_argument("--batch_size", type=int, default=4,
+                        help="Number of patches passed to the model at once during inference. "
+                             "Larger batches improve throughput but use more GPU/CPU memory.")
+    parser.add_argument("--stitching", type=str, default="blend", choices=["blend", "crop"],
+                        help="How overlapping patches are combined: blend (weighted average) or crop "
+                             "(keep the centre of each patch only - faster, uses less memory, may show faint seams).")
+    parser.add_argument("--compiled", action="store_true",
+                        help="Run inference through a compiled tf.function instead of model.predict.")
+    parser.add_argument("--jit_compile", action="store_true",
+                        help="Compile the inference function with XLA (implies --compiled).")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Overlap reading, inference and writing using background threads. "
+                             "Useful when data is stored on slow or network filesystems.")
+    parser.add_argument("--n_readers", type=int, default=2,
+                        help="Number of threads prefetching image patches in pipeline mode.")
+    parser.add_argument("--queue_depth", type=int, default=4,
+                        help="Number of batches that can be queued for inference/writing in pipeline mode.")
+    parser.add_argument("--background_threshold", type=float, default=None,
+                        help="Skip patches containing only background: patches where the chosen intensity statistic "
+                             "(--background_stat) of the normalised image is below this value are labelled as background "
+                             "without running the model. E.g. --background_threshold 0.05")
+    parser.add_argument("--screener_path", type=str, default=None,
+                        help="Screening network weights trained with train_screener.py (optional). Patches the screener "
+                             "scores below --screening_threshold are labelled as background without running the full model.")
+    parser.add_argument("--screening_threshold", type=float, default=0.1,
+                        help="Vessel probability below which the screener skips a patch (default: 0.1). "
+                             "Choose from the report printed by train_screener.py.")
+    parser.add_argument("--background_stat", type=str, default="max", choices=["max", "mean", "std"],
+                        help="Intensity statistic used to identify background patches (default: max).")
+    roi = parser.add_mutually_exclusive_group()
+    roi.add_argument("--roi", type=int, nargs=6, default=None, metavar=("Z0", "Z1", "X0", "X1", "Y0", "Y1"),
+                     help="Only predict this bounding box of each image (voxels). E.g. --roi 0 100 200 400 200 400")
+    roi.add_argument("--roi_mask", type=str, default=None,
+                     help="Only predict the region where this zarr mask (same shape as the image) is nonzero.")
+    parser.add_argument("--roi_output", type=str, default="crop", choices=["crop", "full"],
+                        help="Save outputs covering the region of interest only (crop, with its offset saved in the zarr "
+                             "attributes) or the whole image (full, written only inside the region).")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume interrupted inference (e.g. after hitting a job time limit) from the last completed "
+                             "slab, using the ledger file saved next to each output.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Re-run inference on an existing output, predicting again only the patches affected by "
+                             "image chunks that have changed since the last run (everything if the model or settings changed).")
+    parser.add_argument("--n_shards", type=int, default=1,
+                        help="Split each image into this many shards in the z axis, processed by separate worker processes.")
+    parser.add_argument("--local_workers", type=int, default=None,
+                        help="Number of local worker processes used to run shards. Defaults to one per shard.")
+    parser.add_argument("--shard_id", type=int, default=None,
+                        help="Run a single shard only (e.g. as one task of a cluster job array). "
+                             "Shards are merged afterwards by re-running with --merge_only.")
+    parser.add_argument("--merge_only", action="store_true",
+                        help="Merge shards that have already been run into a single output.")
     parser.add_argument("--binary_output", action="store_true",
-                        help="Save predictions as binary image. Otherwise, the softmax output will be saved.")
+                        help="Save predicted labels only. Otherwise, the softmax output will be saved as well.")
+    parser.add_argument("--softmax_dtype", type=str, default="float32", choices=["float32", "float16", "uint8"],
+                        help="Data type used to store softmax output. uint8 stores probabilities scaled to 0-255.")
+    parser.add_argument("--compressor", type=str, default="default",
+                        choices=["default", "none", "zstd", "gzip", "blosc-zstd", "blosc-lz4"],
+                        help="Compressor used for zarr outputs (blosc codecs use bitshuffle).")
+    parser.add_argument("--compression_level", type=int, default=None,
+                        help="Compression level for zarr outputs (optional).")
     parser.add_argument("--preview", action="store_true",
                         help="Display preview of predicted segmentation during inference.")
     parser.add_argument("--attention", action="store_true",
@@ -132,4 +347,12 @@ if __name__ == "__main__":
     args = parser.parse_args()
     args.volume_dims = parse_dims(args.volume_dims)
     if args.overlap: args.overlap = parse_dims(args.overlap) #Parse if not None
+    if args.inference_dims: args.inference_dims = parse_dims(args.inference_dims)
+    if args.roi: args.roi = tuple(zip(args.roi[0::2], args.roi[1::2])) # ((z0, z1), (x0, x1), (y0, y1))
+    if args.intensity_header:
+        ranges = {tuple(getattr(h, 'intensity_range', None) or ()) for h in tube.load_headers(args.intensity_header)}
+        if len(ranges) != 1 or () in ranges:
+            parser.error("{} does not record a single intensity range (run preprocessing.py again, or give "
+                         "--intensity_range if its datasets were rescaled differently)".format(args.intensity_header))
+        args.intensity_range = ranges.pop()
     main(args)
\ No newline at end of file
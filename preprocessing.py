@@ -8,8 +8,110 @@ Developed by Natalie Holroyd (UCL)
 
 #Import libraries
 import os
-import tUbeNet_functions as tube
+import time
 import argparse
+import dask
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import tUbeNet_functions as tube
+
+def input_size(path):
+    """Size of an input file (or directory of slices) in bytes"""
+    if os.path.isdir(path):
+        return sum(input_size(os.path.join(path, f)) for f in os.listdir(path))
+    return os.path.getsize(path)
+
+def process_dataset(image_path, label_path, output_path, output_name, chunks, val_fraction, crop, percentiles, **layout):
+    """Preprocess one image (and optional labels), and save in zarr format with header files.
+    layout = options for how arrays are stored, passed to save_as_zarr_array (e.g. shards, compressor)
+    Returns the size of the input files (bytes) and the time taken (s)."""
+    start = time.time()
+    # Run preprocessing
+    data, labels, intensity_range = tube.data_preprocessing(image_path=image_path, 
+                                                    label_path=label_path,
+                                                    chunks=chunks,
+                                                    percentiles=percentiles)
+
+    # Crop
+    if crop and labels is not None:
+        labels, data = tube.crop_from_labels(labels, data)
+    
+    # Split into test and train
+    if val_fraction > 0 and labels is not None:
+        
+        train_data, train_labels, test_data, test_labels = tube.split_train_test(labels, data, val_fraction)
+        
+        # Create folders
+        train_folder = os.path.join(output_path,"train")
+        os.makedirs(train_folder, exist_ok=True)
+        train_name = str(output_name)+"_train"
+        
+        test_folder = os.path.join(output_path,"test")
+        os.makedirs(test_folder, exist_ok=True)
+        test_name = str(output_name)+"_test"
+        
+        # Save train data
+        train_name = str(output_name)+"_train"
+        
+        train_path, train_header = tube.save_as_zarr_array(train_data, labels=train_labels, 
+                                                           output_path=train_folder, 
+                                                           output_name=train_name, 
+                                                           chunks=chunks,
+                                                           intensity_range=intensity_range,
+                                                           **layout)
+        print("Processed training data and header files saved to "+str(train_path))
+        
+        # Save test data
+        test_path, test_header = tube.save_as_zarr_array(test_data, labels=test_labels, 
+                                                           output_path=test_folder, 
+                                                           output_name=test_name, 
+                                                           chunks=chunks,
+                                                           intensity_range=intensity_range,
+                                                           **layout)
+        print("Processed test data and header files saved to "+str(test_path))
+        
+    else:
+        save_path, save_header = tube.save_as_zarr_array(data, labels=labels, 
+                                                           output_path=output_path, 
+                                                           output_name=output_name, 
+                                                           chunks=chunks,
+                                                           intensity_range=intensity_range,
+                                                           **layout)
+        print("Processed data and header files saved to "+str(save_path))
+    
+    n_bytes = input_size(image_path) + (input_size(label_path) if label_path is not None else 0)
+    return n_bytes, time.time()-start
+
+def benchmark(dataset, chunks, percentiles, layout, output_path, max_size=512):
+    """Compare write/read throughput and number of files of zarr layouts on (up to max_size^3 voxels of) 
+    one preprocessed dataset: one file per chunk, shards of 4x4x4 chunks with different codecs, and the layout 
+    chosen with the command line options. Nothing is saved."""
+    image_path, label_path, output_name = dataset
+    data, labels, _ = tube.data_preprocessing(image_path=image_path, label_path=label_path, chunks=chunks,
+                                              percentiles=percentiles)
+    shards = tuple(4*c for c in chunks)
+    chosen = {'chunks': chunks, 'shards': layout['shards'], 'compressor': layout['compressor'], 
+              'compression_level': layout['compression_level']}
+    layouts = [{'chunks': chunks},
+               {'chunks': chunks, 'shards': shards},
+               {'chunks': chunks, 'shards': shards, 'compressor': 'blosc-zstd'},
+               {'chunks': chunks, 'shards': shards, 'compressor': 'blosc-lz4'},
+               {k: v for k, v in chosen.items() if v is not None}]
+    os.makedirs(output_path, exist_ok=True)
+    print("Benchmarking image layouts on {}".format(output_name))
+    tube.benchmark_zarr_layouts(data[:max_size, :max_size, :max_size], output_path, layouts, window=chunks)
+    
+    if labels is not None:
+        chosen = {'chunks': layout['label_chunks'] or chunks, 
+                  'shards': layout['label_shards'] or layout['shards'],
+                  'dtype': layout['label_dtype'],
+                  'compressor': layout['label_compressor'] or layout['compressor'],
+                  'compression_level': layout['label_compression_level'] or layout['compression_level']}
+        layouts = [{'chunks': chunks},
+                   {'chunks': chunks, 'shards': shards, 'dtype': 'uint8'},
+                   {'chunks': chunks, 'shards': shards, 'dtype': 'uint8', 'compressor': 'zstd', 'compression_level': 9},
+                   {k: v for k, v in chosen.items() if v is not None}]
+        print("Benchmarking label layouts on {}".format(output_name))
+        tube.benchmark_zarr_layouts(labels[:max_size, :max_size, :max_size], output_path, layouts, window=chunks)
 
 def main(args):
     #----------------------------------------------------------------------------------------------------------------------------------------------
@@ -45,6 +147,7 @@ def main(args):
         print("Label files:")
         print(*label_filenames, sep="\n")   
     
+    datasets = []
     for image_filename, label_filename in zip(image_filenames, label_filenames):
         # Set names and paths
         output_name = os.path.splitext(image_filename)[0]
@@ -52,54 +155,58 @@ def main(args):
         if label_filename is not None: 
             label_path = os.path.join(label_directory, label_filename)
         else: label_path = None
-            
-        # Run preprocessing
-        data, labels = tube.data_preprocessing(image_path=image_path, 
-                                                        label_path=label_path,
-                                                        chunks=chunks)
-
-        # Crop
-        if crop and labels is not None:
-            labels, data = tube.crop_from_labels(labels, data)
-        
-        # Split into test and train
-        if val_fraction > 0 and labels is not None:
-            
-            train_data, train_labels, test_data, test_labels = tube.split_train_test(labels, data, val_fraction)
-            
-            # Create folders
-            train_folder = os.path.join(output_path,"train")
-            if not os.path.exists(train_folder):
-                os.makedirs(train_folder)
-            train_name = str(output_name)+"_train"
-            
-            test_folder = os.path.join(output_path,"test")
-            if not os.path.exists(test_folder):
-                os.makedirs(test_folder)
-            test_name = str(output_name)+"_test"
-            
-            # Save train data
-            train_name = str(output_name)+"_train"
-            
-            train_path, train_header = tube.save_as_zarr_array(train_data, labels=train_labels, 
-                                                               output_path=train_folder, 
-                                                               output_name=train_name, 
-                                                               chunks=chunks)
-            print("Processed training data and header files saved to "+str(train_path))
-            
-            # Save test data
-            test_path, test_header = tube.save_as_zarr_array(test_data, labels=test_labels, 
-                                                               output_path=test_folder, 
-                                                               output_name=test_name, 
-                                                               chunks=chunks)
-            print("Processed test data and header files saved to "+str(test_path))
-            
-        else:
-            save_path, save_header = tube.save_as_zarr_array(data, labels=labels, 
-                                                               output_path=output_path, 
-                                                               output_name=output_name, 
-                                                               chunks=chunks)
-            print("Processed data and header files saved to "+str(save_path))
+        datasets.append((image_path, label_path, output_name))
+    
+    # How arrays are stored (see tube.save_as_zarr_array)
+    layout = {'shards': args.shards,
+              'compressor': args.compressor,
+              'compression_level': args.compression_level,
+              'label_chunks': args.label_chunks,
+              'label_shards': args.label_shards,
+              'label_dtype': args.label_dtype,
+              'label_compressor': args.label_compressor,
+              'label_compression_level': args.label_compression_level}
+    
+    if args.benchmark:
+        benchmark(datasets[0], chunks, args.intensity_percentiles, layout, output_path)
+        return
+    
+    # Optional local cluster of worker processes: the computations of every dataset run on the workers,
+    # and several datasets are processed at the same time
+    client = None
+    if args.workers:
+        try:
+            from dask.distributed import LocalCluster, Client
+        except ImportError:
+            raise ImportError("--workers requires dask.distributed (pip install distributed)")
+        cluster = LocalCluster(n_workers=args.workers, threads_per_worker=1, processes=True, 
+                               memory_limit=args.memory_limit or 'auto')
+        client = Client(cluster)
+        # Rechunking from slabs of planes to chunks is bounded per row of chunks, so does not need a shuffle
+        dask.config.set({"array.rechunk.method": "tasks"})
+        print("Started {} worker processes (dashboard: {})".format(args.workers, client.dashboard_link))
+    
+    start = time.time()
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(args.workers or 1, len(datasets)))) as pool:
+            futures = {pool.submit(process_dataset, image_path, label_path, output_path, output_name, chunks, 
+                                   val_fraction, crop, args.intensity_percentiles, **layout): output_name
+                       for image_path, label_path, output_name in datasets}
+            for future in as_completed(futures):
+                n_bytes, seconds = future.result()
+                results.append((futures[future], n_bytes, seconds))
+                print("[{}/{}] {} finished: {:.0f} MB in {:.1f} s ({:.1f} MB/s)".format(
+                    len(results), len(datasets), futures[future], n_bytes/1e6, seconds, n_bytes/1e6/seconds))
+    finally:
+        if client is not None:
+            client.close()
+            cluster.close()
+    
+    # Summary
+    total_bytes, total_time = sum(r[1] for r in results), time.time()-start
+    print("Preprocessed {} datasets: {:.0f} MB in {:.1f} s ({:.1f} MB/s)".format(
+        len(results), total_bytes/1e6, total_time, total_bytes/1e6/total_time))
 
 def parse_chunks(values):
     if len(values) == 1:
@@ -123,13 +230,47 @@ if __name__ == "__main__":
                         help="Chunk size for saving zarr files. "
                              "Provide 1 value (isotropic) or 3 values (anisotropic). "
                              "E.g. --chunks 64 OR --chunks 64 64 32")
+    parser.add_argument("--shards", type=int, nargs="+", default=None,
+                        help="Shard size: store many chunks in each file (zarr v3 sharding), to reduce the number of "
+                             "files. Must be a multiple of --chunks, e.g. --chunks 64 --shards 256. "
+                             "Default: one file per chunk.")
+    parser.add_argument("--compressor", type=str, default="default",
+                        choices=["default", "none", "zstd", "gzip", "blosc-zstd", "blosc-lz4"],
+                        help="Compressor used for each chunk (blosc codecs use bitshuffle).")
+    parser.add_argument("--compression_level", type=int, default=None,
+                        help="Compression level (optional).")
+    parser.add_argument("--label_chunks", type=int, nargs="+", default=None,
+                        help="Chunk size for labels, if different from --chunks.")
+    parser.add_argument("--label_shards", type=int, nargs="+", default=None,
+                        help="Shard size for labels, if different from --shards.")
+    parser.add_argument("--label_dtype", type=str, default=None, choices=["int16", "uint8"],
+                        help="Data type of saved labels (default: int16). uint8 halves the size of labels with up to 255 classes.")
+    parser.add_argument("--label_compressor", type=str, default=None,
+                        choices=["default", "none", "zstd", "gzip", "blosc-zstd", "blosc-lz4"],
+                        help="Compressor for labels, if different from --compressor.")
+    parser.add_argument("--label_compression_level", type=int, default=None,
+                        help="Compression level for labels, if different from --compression_level.")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="Instead of preprocessing, report write/read throughput and file counts of several zarr "
+                             "layouts (and the layout chosen with the options above) on the first dataset.")
     parser.add_argument("--val_fraction", type=float, default=0.0,
                         help="Fraction of data to use for validation (0-1)")
     parser.add_argument("--crop", action='store_true',
                         help="Enable cropping if there are large background sections with no vessels")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Number of worker processes in a local dask cluster (requires dask.distributed). "
+                             "Datasets are processed at the same time, up to one per worker. "
+                             "Default: process datasets one after another in this process.")
+    parser.add_argument("--memory_limit", type=str, default=None,
+                        help="Memory limit for each worker process, e.g. 4GB. Default: system memory shared between workers.")
+    parser.add_argument("--intensity_percentiles", type=float, nargs=2, default=[0, 100],
+                        help="Percentiles of image intensities rescaled to 0 and 1, with values outside clipped "
+                             "(e.g. 0.5 99.5 to ignore hot pixels). Default: minimum and maximum.")
                                
 
     args = parser.parse_args() 
     args.chunks = parse_chunks(args.chunks) #create tuple of values for chunk dimensions
+    for name in ('shards', 'label_chunks', 'label_shards'):
+        if getattr(args, name): setattr(args, name, parse_chunks(getattr(args, name)))
     
     main(args)
\ No newline at end of file
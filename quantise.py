@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Exports trained tUbeNet weights to a (quantised) TFLite model for CPU inference 
+and compares it against the float model on a reference volume.
+"""
+
+#Import libraries
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' #Suppress info logs from tf 
+import argparse
+from model import tUbeNet
+import tUbeNet_functions as tube
+from tUbeNet_classes import DataDir, TFLiteModel
+
+def main(args):
+    """Set parameters and file paths:"""
+    # Paramters
+    volume_dims = args.volume_dims
+    overlap = args.overlap
+    n_classes = args.n_classes
+    batch_size = args.batch_size
+    quantisation = None if args.quantisation == 'none' else args.quantisation
+    attention = args.attention
+
+    data_headers = args.data_headers
+    model_path = args.model_path
+    output_path = args.output_path
+    
+    #----------------------------------------------------------------------------------------------------------------------------------------------
+    """ Create Data Directory"""
+    # Load data headers from the catalogue (or pickled header files from earlier versions)
+    headers = tube.load_headers(data_headers)
+    
+    # Create empty data directory    
+    data_dir = DataDir([], image_dims=[], 
+                       image_filenames=[], 
+                       label_filenames=[], 
+                       data_type=[], exclude_region=[])
+    
+    # Fill directory from headers
+    for header in headers:
+        data_dir.list_IDs.append(header.ID)
+        data_dir.image_dims.append(header.image_dims)
+        data_dir.image_filenames.append(header.image_filename)
+        data_dir.label_filenames.append(None) #Labels not required for calibration
+        data_dir.data_type.append('float32')
+        data_dir.exclude_region.append((None,None,None))
+    
+    """ Load Model """
+    tubenet = tUbeNet(n_classes=n_classes, input_dims=volume_dims, attention=attention)
+    model = tubenet.load_weights(filename=model_path, loss='DICE CE')
+    
+    """ Export TFLite model """
+    os.makedirs(output_path, exist_ok=True)
+    tflite_name = os.path.join(output_path, os.path.basename(model_path).split('.')[0]+"_{}.tflite".format(args.quantisation))
+    calibration_data = None
+    if quantisation == 'int8':
+        # Calibrate activation ranges on windows drawn from the data
+        calibration_data = list(tube.calibration_patches(data_dir, volume_dims=volume_dims, n_patches=args.n_calibration))
+    tubenet.export_tflite(model, tflite_name, quantisation=quantisation, calibration_data=calibration_data)
+    if quantisation == 'int8':
+        # Ops without int8 kernels in TFLite (e.g. 3D convolutions) stay float
+        ops = tube.tflite_op_summary(tflite_name)
+        n_int8, n_float = sum(ops['int8'].values()), sum(ops['float'].values())
+        print("{} of {} ops run in int8. Float ops: {}".format(n_int8, n_int8+n_float, 
+              ", ".join("{} x{}".format(name, n) for name, n in sorted(ops['float'].items())) or "none"))
+    
+    """ Compare against float model """
+    if not args.no_compare:
+        if not overlap:
+            overlap = (volume_dims[0]//2,volume_dims[1]//2,volume_dims[2]//2)
+        # Compiled float model as the reference, so the speedup is not inflated by model.predict overheads
+        reference_model = tubenet.inference_function(model, batch_size=batch_size)
+        print("Comparing against float model on {}".format(data_dir.image_filenames[0]))
+        tube.compare_models(reference_model, TFLiteModel(tflite_name, num_threads=args.num_threads),
+                            data_dir.image_filenames[0], output_path, 
+                            volume_dims=volume_dims, overlap=overlap, n_classes=n_classes, 
+                            batch_size=batch_size, z_range=args.z_range)
+
+def parse_dims(values):
+    """Parse volume dimensions: allow either one int (isotropic) or three ints (anisotropic)."""
+    if len(values) == 1:
+        return (values[0], values[0], values[0])
+    elif len(values) == 3:
+        return tuple(values)
+    else:
+        raise argparse.ArgumentTypeError(
+            "volume_dims must be either a single value (e.g. --volume_dims 64) "
+            "or three values (e.g. --volume_dims 64 64 32).")
+    
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export TubeNet model to quantised TFLite model for CPU inference.")
+
+    parser.add_argument("--data_headers", type=str, required=True,
+                        help="Path to directory containing preprocessed header files. Used for calibration; "
+                             "the first image is used as the reference volume for comparison.")
+    parser.add_argument("--model_path", type=str, required=True,
+                        help="Path to trained model (.h5 file).")
+    parser.add_argument("--output_path", type=str, required=True,
+                        help="Directory where the TFLite model and comparison predictions will be saved.")
+    parser.add_argument("--quantisation", type=str, default="dynamic", choices=["dynamic", "int8", "float16", "none"],
+                        help="Post-training quantisation: dynamic (int8 weights), int8 (int8 weights and activations, "
+                             "calibrated on the data - 3D convolutions stay float), float16 or none.")
+    parser.add_argument("--n_calibration", type=int, default=100,
+                        help="Number of image patches used to calibrate int8 quantisation.")
+    parser.add_argument("--no_compare", action="store_true",
+                        help="Skip comparison with the float model.")
+    parser.add_argument("--z_range", type=int, nargs=2, default=None,
+                        help="Only compare predictions on these planes of the reference volume (start stop).")
+    parser.add_argument("--num_threads", type=int, default=None,
+                        help="Number of CPU threads used by the TFLite model.")
+
+    parser.add_argument("--volume_dims", type=int, nargs="+", default=[64, 64, 64],
+                        help="Volume dimensions passed to CNN. Provide 1 value (isotropic) "
+                             "or 3 values (anisotropic). E.g. --volume_dims 64 OR --volume_dims 32 64 64")
+    parser.add_argument("--overlap", type=int, nargs="+", default=None,
+                        help="Overlap between patches during inference. Provide 1 value (isotropic) "
+                             "or 3 values (anisotropic). Defaults to half of volume_dims.")
+    parser.add_argument("--batch_size", type=int, default=4,
+                        help="Number of patches passed to the model at once during inference.")
+    parser.add_argument("--attention", action="store_true",
+                        help="Use this flag if loading a tubenet model built with attention blocks") 
+    parser.add_argument("--n_classes", type=int, default=2,
+                        help="Number of classes to predict.")
+
+    args = parser.parse_args()
+    args.volume_dims = parse_dims(args.volume_dims)
+    if args.overlap is not None:
+        args.overlap = parse_dims(args.overlap)
+    main(args)
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Long-running inference server. Keeps trained tUbeNet models loaded (and warmed up) and runs prediction jobs
+submitted over a local HTTP API, so each job avoids the start-up cost of tensorflow and model loading.
+"""
+
+#Import libraries
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' #Suppress info logs from tf
+import json
+import time
+import argparse
+import threading
+import traceback
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import tUbeNet_functions as tube
+from tUbeNet_classes import BatchingPredictor
+from predict import load_model, parse_dims
+
+# Inference settings a job may set, passed on to predict_segmentation_dask
+JOB_SETTINGS = ('batch_size', 'stitching', 'pipeline', 'n_readers', 'queue_depth', 'z_range', 'background_threshold',
+                'background_stat', 'resume', 'save_softmax', 'softmax_dtype', 'compressor', 'compression_level',
+                'intensity_range', 'intensity_percentiles', 'roi', 'roi_output')
+# Job states in which a job may still write to its output
+ACTIVE = ('queued', 'running')
+
+class JobConflictError(ValueError):
+    'A job writing to the same output is already queued or running'
+
+class InferenceServer:
+    """Queue of inference jobs, run on a pool of max_jobs threads.
+    Jobs share the loaded models through BatchingPredictors, which combine windows from concurrent jobs into
+    larger batches. Job settings not given are taken from defaults. Only the last max_history finished jobs
+    are kept."""
+    def __init__(self, predictors, volume_dims, n_classes=2, max_jobs=2, fixed_dims=False, defaults=None, 
+                 max_history=1000):
+        'Initialization'
+        self.predictors = predictors     # dict of model name: BatchingPredictor
+        self.volume_dims = volume_dims
+        self.n_classes = n_classes
+        self.fixed_dims = fixed_dims     # compiled models only accept windows of volume_dims
+        self.defaults = defaults or {}
+        self.max_history = max_history
+        self.executor = ThreadPoolExecutor(max_workers=max_jobs)
+        self.jobs = {}
+        self.futures = {}
+        self.ids = count(1)
+        self.lock = threading.Lock()
+
+    def submit(self, request):
+        'Check a job request and add it to the queue. Returns the job record.'
+        request = dict(request)
+        image_path = request.pop('image_path', None)
+        output_path = request.pop('output_path', None)
+        if not image_path or not output_path:
+            raise ValueError("Jobs must give image_path and output_path")
+        model_name = request.pop('model', next(iter(self.predictors)))
+        if model_name not in self.predictors:
+            raise ValueError("Unknown model {} - loaded models are {}".format(model_name, list(self.predictors)))
+        tiff_path = request.pop('tiff_path', None)
+
+        # Window and overlap, defaulting to the server's volume_dims and half a window
+        volume_dims = parse_dims(request.pop('volume_dims', None) or list(self.volume_dims))
+        if any(d % 32 for d in volume_dims):
+            raise ValueError("Inference window {} must be a multiple of 32 on each axis".format(volume_dims))
+        if self.fixed_dims and tuple(volume_dims) != tuple(self.volume_dims):
+            raise ValueError("Compiled models only accept windows of {}".format(self.volume_dims))
+        overlap = request.pop('overlap', None)
+        overlap = parse_dims(overlap) if overlap else tuple(d//2 for d in volume_dims)
+
+        unknown = [key for key in request if key not in JOB_SETTINGS]
+        if unknown:
+            raise ValueError("Unknown job settings {}. Valid settings are {}".format(unknown, list(JOB_SETTINGS)))
+        settings = dict(self.defaults, **request)
+
+        with self.lock:
+            # Concurrent jobs would write the same zarr store (and its resume ledger)
+            for other in self.jobs.values():
+                if other['status'] in ACTIVE and os.path.abspath(other['output_path']) == os.path.abspath(output_path):
+                    raise JobConflictError("Job {} is already writing to {}".format(other['id'], output_path))
+            job_id = str(next(self.ids))
+            job = {'id': job_id,
+                   'status': 'queued',
+                   'model': model_name,
+                   'image_path': image_path,
+                   'output_path': output_path,
+                   'tiff_path': tiff_path,
+                   'volume_dims': list(volume_dims),
+                   'overlap': list(overlap),
+                   'settings': settings,
+                   'patches_done': 0,
+                   'patches_total': None,
+                   'submitted': time.time(),
+                   'started': None,
+                   'finished': None,
+                   'error': None}
+            self.jobs[job_id] = job
+            self.futures[job_id] = self.executor.submit(self._run, job)
+            self._prune()
+        print("Job {} queued: {} -> {}".format(job_id, image_path, output_path))
+        return job
+
+    def _run(self, job):
+        job['status'], job['started'] = 'running', time.time()
+
+        def progress(n_done, n_total):
+            job['patches_done'], job['patches_total'] = int(n_done), int(n_total)
+
+        try:
+            tube.predict_segmentation_dask(self.predictors[job['model']],
+                                           job['image_path'],
+                                           job['output_path'],
+                                           volume_dims=job['volume_dims'],
+                                           overlap=job['overlap'],
+                                           n_classes=self.n_classes,
+                                           export_bigtiff=job['tiff_path'],
+                                           progress=progress,
+                                           **job['settings'])
+            job['status'] = 'done'
+        except Exception as e:
+            traceback.print_exc()
+            job['status'], job['error'] = 'failed', "{}: {}".format(type(e).__name__, e)
+        job['finished'] = time.time()
+        print("Job {} {} in {:.1f} s".format(job['id'], job['status'], job['finished']-job['started']))
+        with self.lock:
+            self._prune()
+
+    def _prune(self):
+        # Forget the oldest finished jobs beyond max_history (called with the lock held)
+        finished = [job_id for job_id, job in self.jobs.items() if job['status'] not in ACTIVE]
+        for job_id in finished[:max(0, len(finished)-self.max_history)]:
+            del self.jobs[job_id], self.futures[job_id]
+
+    def cancel(self, job_id):
+        'Remove a queued job from the queue. Returns False if the job has already started.'
+        with self.lock:
+            if job_id in self.futures and self.futures[job_id].cancel():
+                self.jobs[job_id]['status'] = 'cancelled'
+                return True
+        return False
+
+    def status(self):
+        'Summary of loaded models and jobs'
+        models = {name: {'calls': predictor.n_calls,
+                         'windows': predictor.n_windows,
+                         'mean_batch': predictor.n_windows/max(predictor.n_calls, 1)}
+                  for name, predictor in self.predictors.items()}
+        jobs = {}
+        for job in list(self.jobs.values()):
+            jobs[job['status']] = jobs.get(job['status'], 0) + 1
+        return {'models': models, 'volume_dims': list(self.volume_dims), 'n_classes': self.n_classes, 'jobs': jobs}
+
+    def close(self):
+        'Cancel queued jobs, wait for running jobs to finish and stop the model threads'
+        for job_id in list(self.futures):
+            self.cancel(job_id)
+        self.executor.shutdown(wait=True)
+        for predictor in self.predictors.values():
+            predictor.close()
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """JSON API for InferenceServer:
+    POST /jobs        submit a job, returns the job record (including its id)
+    GET /jobs         list all jobs
+    GET /jobs/<id>    status and progress of one job
+    DELETE /jobs/<id> cancel a queued job
+    GET /status       loaded models and number of jobs in each state"""
+
+    def send_json(self, code, body):
+        data = json.dumps(body, indent=2).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def job_id(self):
+        # Job id from a /jobs/<id> path, or None
+        parts = self.path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs' and parts[1] in self.server.inference.jobs:
+            return parts[1]
+        return None
+
+    def do_GET(self):
+        inference = self.server.inference
+        if self.path.rstrip('/') == '/status':
+            self.send_json(200, inference.status())
+        elif self.path.rstrip('/') == '/jobs':
+            self.send_json(200, list(inference.jobs.values()))
+        else:
+            job = inference.jobs.get(self.job_id()) # None if finished long ago and no longer kept
+            if job is not None:
+                self.send_json(200, job)
+            else:
+                self.send_json(404, {'error': 'Not found: {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path.rstrip('/') != '/jobs':
+            self.send_json(404, {'error': 'Not found: {}'.format(self.path)})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError("Job request must be a JSON object")
+            job = self.server.inference.submit(request)
+        except JobConflictError as e:
+            self.send_json(409, {'error': str(e)})
+            return
+        except (ValueError, TypeError, argparse.ArgumentTypeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(202, job)
+
+    def do_DELETE(self):
+        job_id = self.job_id()
+        job = self.server.inference.jobs.get(job_id)
+        if job is None:
+            self.send_json(404, {'error': 'Not found: {}'.format(self.path)})
+        elif self.server.inference.cancel(job_id):
+            self.send_json(200, job)
+        else:
+            self.send_json(409, {'error': 'Job {} has already started'.format(job_id)})
+
+    def log_message(self, format, *args):
+        pass # Jobs are logged by InferenceServer instead of every request (e.g. progress polling)
+
+def main(args):
+    """Set parameters and file paths:"""
+    volume_dims = args.volume_dims
+    n_classes = args.n_classes
+    max_batch = args.max_batch
+
+    """ Load and warm up models """
+    predictors = {}
+    for model_path in args.model_path:
+        name = os.path.basename(model_path).split('.')[0]
+        model = load_model(model_path, volume_dims, n_classes, args.attention,
+                           args.compiled, args.jit_compile, max_batch)
+        predictors[name] = BatchingPredictor(model, max_batch=max_batch, max_wait=args.max_wait)
+        # First call builds the model graph, so it is not paid for by the first job
+        t0 = time.perf_counter()
+        predictors[name](np.zeros((max_batch, *volume_dims, 1), dtype=np.float32))
+        print("Loaded model {} from {} (warm-up {:.1f} s)".format(name, model_path, time.perf_counter()-t0))
+
+    """ Start server """
+    defaults = {'batch_size': args.batch_size}
+    inference = InferenceServer(predictors, volume_dims, n_classes=n_classes, max_jobs=args.max_jobs,
+                                fixed_dims=args.compiled or args.jit_compile, defaults=defaults, 
+                                max_history=args.max_history)
+    server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+    server.inference = inference
+    print("Inference server listening on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Shutting down - waiting for running jobs to finish")
+    finally:
+        server.server_close()
+        inference.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run TubeNet inference server.")
+
+    parser.add_argument("--model_path", type=str, nargs="+", required=True,
+                        help="Path(s) to trained models (.h5, or .tflite exported with quantise.py). "
+                             "Jobs choose a model by its filename without extension (defaults to the first).")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="Address to listen on. Defaults to localhost only.")
+    parser.add_argument("--port", type=int, default=8765,
+                        help="Port to listen on.")
+    parser.add_argument("--volume_dims", type=int, nargs="+", default=[64, 64, 64],
+                        help="Default inference window. Provide 1 value (isotropic) or 3 values (anisotropic). "
+                             "Jobs may use other windows (multiples of 32) unless the models are compiled.")
+    parser.add_argument("--n_classes", type=int, default=2,
+                        help="Number of classes predicted by the models.")
+    parser.add_argument("--attention", action="store_true",
+                        help="Use this flag if loading tubenet models built with attention blocks")
+    parser.add_argument("--compiled", action="store_true",
+                        help="Run inference through a compiled tf.function instead of model.predict.")
+    parser.add_argument("--jit_compile", action="store_true",
+                        help="Compile the inference function with XLA (implies --compiled).")
+    parser.add_argument("--max_jobs", type=int, default=2,
+                        help="Number of jobs run at the same time. Further jobs wait in a queue.")
+    parser.add_argument("--max_history", type=int, default=1000,
+                        help="Number of finished jobs kept for GET /jobs. Older finished jobs are forgotten.")
+    parser.add_argument("--batch_size", type=int, default=4,
+                        help="Default number of patches each job passes to the model at once.")
+    parser.add_argument("--max_batch", type=int, default=8,
+                        help="Maximum number of patches passed to the model in one call, combined across jobs.")
+    parser.add_argument("--max_wait", type=float, default=0.005,
+                        help="Time (s) to wait for patches from other jobs before calling the model.")
+
+    args = parser.parse_args()
+    args.volume_dims = parse_dims(args.volume_dims)
+    main(args)
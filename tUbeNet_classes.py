@@ -9,8 +9,12 @@ Developed by Natalie Holroyd (UCL)
 import numpy as np
 import math
 import random
-import pickle
+import json
 import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
 join = os.path.join
 
 import io
@@ -22,18 +26,19 @@ import dask.array as da
 from tensorflow.keras.utils import Sequence, to_categorical #np_utils
 #---------------------------------------------------------------------------------------------------------------------------------------------
 class DataHeader:
-    def __init__(self, ID=None, image_dims=(1024,1024,1024), image_filename=None, label_filename=None):
+    def __init__(self, ID=None, image_dims=(1024,1024,1024), image_filename=None, label_filename=None, intensity_range=None,
+                 foreground_filename=None):
 	    'Initialization' 
 	    self.ID = ID
 	    self.image_dims = image_dims
 	    self.image_filename = image_filename
 	    self.label_filename = label_filename
-    def save(self, filename):
-        with open(filename, 'wb') as f:
-            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+	    self.intensity_range = intensity_range # (min, max) raw intensities rescaled to 0 and 1
+	    self.foreground_filename = foreground_filename # Fraction of labelled voxels in each block (see foreground_fractions)
 
 class DataDir:
-	def __init__(self, list_IDs, image_dims=(1024,1024,1024), image_filenames=None, label_filenames=None, data_type='float64', exclude_region=None):
+	def __init__(self, list_IDs, image_dims=(1024,1024,1024), image_filenames=None, label_filenames=None, data_type='float64', exclude_region=None,
+              foreground_filenames=None):
 	    'Initialization'    
 	    self.image_dims = image_dims
 	    self.image_filenames = image_filenames
@@ -41,6 +46,7 @@ class DataDir:
 	    self.list_IDs = list_IDs
 	    self.data_type = data_type
 	    self.exclude_region = exclude_region
+	    self.foreground_filenames = foreground_filenames # Foreground indexes (optional, None for each dataset without one)
 
 class DataGenerator(Sequence):
 	def __init__(self, data_dir, batch_size=32, volume_dims=(64,64,64), shuffle=True, n_classes=2, 
@@ -62,6 +68,50 @@ class DataGenerator(Sequence):
 	    self._images = [da.from_zarr(p) for p in self.data_dir.image_filenames]
 	    self._labels = [da.from_zarr(p) for p in self.data_dir.label_filenames]
 	    
+	    # Blocks of each dataset's foreground index above vessel_threshold, from which windows are sampled
+	    # (None to sample windows anywhere)
+	    foreground_filenames = getattr(self.data_dir, 'foreground_filenames', None) or [None]*len(self.data_dir.list_IDs)
+	    self._foreground = [self._foreground_blocks(p, dims) for p, dims in zip(foreground_filenames, self.data_dir.image_dims)]
+	    
+	def _foreground_blocks(self, filename, image_dims):
+	    # Blocks from which windows can be sampled, and block size. Where windows are at least one block, a window
+	    # containing a whole block holds all of its labelled voxels, so blocks holding enough of them for any such
+	    # window to pass vessel_threshold are used. Otherwise (or if there are none) blocks above vessel_threshold.
+	    if filename is None or self.vessel_threshold < 0:
+	        return None
+	    import zarr
+	    index = zarr.open_array(filename, mode='r')
+	    fractions, block = index[:], tuple(index.attrs['block'])
+	    whole = all(v >= b for v, b in zip(self.volume_dims, block))
+	    if whole:
+	        # Labelled voxels in each block (blocks at the edges of the image are smaller)
+	        sizes = [np.minimum(b, d-np.arange(n)*b) for b, d, n in zip(block, image_dims, fractions.shape)]
+	        counts = fractions*sizes[0][:,None,None]*sizes[1][None,:,None]*sizes[2][None,None,:]
+	        blocks = np.argwhere(counts > self.vessel_threshold*np.prod(self.volume_dims))
+	    if not whole or len(blocks) == 0:
+	        whole, blocks = False, np.argwhere(fractions > self.vessel_threshold)
+	    if len(blocks) == 0:
+	        return None
+	    return blocks, block, whole
+	    
+	def foreground_coordinates(self, image_dims, exclude_region, foreground, max_tries=10):
+	    'Random window origin, such that the window contains a random block (or voxel of a block) from the foreground index'
+	    blocks, block, whole = foreground
+	    for _ in range(max_tries):
+	        b = blocks[random.randrange(len(blocks))]
+	        coords = np.zeros(3, dtype=int)
+	        for ax in range(3):
+	            if whole:
+	                first, last = b[ax]*block[ax], min((b[ax]+1)*block[ax], image_dims[ax])-1
+	            else:
+	                first = last = min(b[ax]*block[ax]+random.randrange(block[ax]), image_dims[ax]-1)
+	            coords[ax] = random.randint(max(0, last-self.volume_dims[ax]+1), min(first, image_dims[ax]-self.volume_dims[ax]))
+	        excluded = [exclude_region[ax] is not None and 
+	                    exclude_region[ax][0]-self.volume_dims[ax] <= coords[ax] < exclude_region[ax][1] for ax in range(3)]
+	        if not any(excluded):
+	            return coords
+	    return self.random_coordinates(image_dims, exclude_region)
+	    
 	def __len__(self):
 		'Denotes the max number of batches per epoch'
 		batches=0 
@@ -120,7 +170,12 @@ class DataGenerator(Sequence):
 			while not vessels_present:
                 #Generate random coordinates within dataset
 				count+=1
-				z0, x0, y0 = self.random_coordinates(self.data_dir.image_dims[index], 
+				if self._foreground[index] is not None:
+					# Sample from blocks known to contain vessels (see tUbeNet_functions.foreground_fractions)
+					z0, x0, y0 = self.foreground_coordinates(self.data_dir.image_dims[index], 
+                                                        self.data_dir.exclude_region[index], self._foreground[index])
+				else:
+					z0, x0, y0 = self.random_coordinates(self.data_dir.image_dims[index], 
                                                     self.data_dir.exclude_region[index])
 				dz, dx, dy = self.volume_dims
                 #Load labels at coordinates
@@ -175,6 +230,25 @@ class DataGenerator(Sequence):
 	    return X, y
     
     
+class ScreeningGenerator(Sequence):
+    """Batches of image windows from a DataGenerator, labelled by whether they contain vessels, for training a 
+    screening network (see tUbeNet.build_screener). Windows with at least min_voxels labelled vessel voxels are 
+    class 1. Use a DataGenerator with vessel_threshold=-1, so that windows are drawn without a preference for 
+    vessels and empty windows are seen as often as they occur in the data."""
+    def __init__(self, generator, min_voxels=1, **kwargs):
+        'Initialization'
+        super().__init__(**kwargs)
+        self.generator = generator
+        self.min_voxels = min_voxels
+        
+    def __len__(self):
+        return len(self.generator)
+    
+    def __getitem__(self, index):
+        X, y = self.generator[index]
+        vessel_voxels = y[..., 1:].sum(axis=(1, 2, 3, 4))
+        return X, to_categorical((vessel_voxels >= self.min_voxels).astype(int), num_classes=2)
+    
 class MetricDisplayCallback(tf.keras.callbacks.Callback):
 
     def __init__(self,log_dir=None):
@@ -271,3 +345,347 @@ class FilterDisplayCallback(tf.keras.callbacks.Callback):
             
         with self.file_writer.as_default():
             tf.summary.image("Convolution 1 filters from layer "+str(layer.name), image, step=epoch)
+
+#---------------------------------------------------------------------------------------------------------------------------------------------
+class SlabAccumulator:
+    """Rolling in-memory accumulator for sliding-window inference.
+    Holds the weighted sum of predictions for one slab of windows in the z axis (depth = volume_dims[0]). 
+    When every window starting at a given z position has been added, the first 'stride' planes can 
+    receive no further contributions, so they are passed to sink(z0, planes) exactly once (e.g. to be 
+    normalised and written to disk) and the buffer is rolled forward. Summed weights are not stored - 
+    see blending_weights."""
+    def __init__(self, sink, shape, volume_dims=(64,64,64), stride=(32,32,32), z_start=0, write_from=0):
+        'Initialization'
+        self.sink = sink # function sink(z0, planes) receiving finished planes (N,X,Y,C) starting at plane z0
+        self.shape = tuple(int(s) for s in shape) # (Z,X,Y,C) shape of the (padded) volume being accumulated
+        self.volume_dims = volume_dims
+        self.stride = stride
+        self.z_start = int(z_start) # z position of the first plane held in the buffer
+        self.write_from = int(write_from) # planes before this are never passed on (e.g. already complete when resuming)
+        self.buffer = np.zeros((int(volume_dims[0]), *self.shape[1:]), dtype=np.float32)
+        
+    def add(self, z0, x0, y0, pred, weight):
+        'Add a weighted prediction (Z,X,Y,C) for the window with origin (z0, x0, y0)'
+        dz = z0 - self.z_start
+        if dz < 0 or dz + pred.shape[0] > self.buffer.shape[0]:
+            raise ValueError("Window at z={} falls outside the current slab (z={}:{})".format(
+                z0, self.z_start, self.z_start+self.buffer.shape[0]))
+        x1 = x0 + pred.shape[1]
+        y1 = y0 + pred.shape[2]
+        self.buffer[dz:dz+pred.shape[0], x0:x1, y0:y1, :] += pred * weight
+        
+    def read_plane(self, z):
+        'Return the (partially) accumulated sum for plane z, which must still be in the buffer'
+        return self.buffer[z-self.z_start]
+        
+    def flush(self, z_end=None):
+        'Pass planes z_start:z_end to the sink and roll the buffer. Flushes the whole buffer if z_end is None'
+        if z_end is None:
+            z_end = min(self.z_start + self.buffer.shape[0], self.shape[0])
+        n = min(z_end - self.z_start, self.buffer.shape[0])
+        if n <= 0:
+            return
+        skip = min(max(self.write_from - self.z_start, 0), n)
+        if skip < n:
+            self.sink(self.z_start+skip, self.buffer[skip:n])
+        
+        # Roll buffer forward and clear the planes now free for the next slab
+        self.buffer[:-n] = self.buffer[n:]
+        self.buffer[-n:] = 0
+        self.z_start = z_end
+
+class SlabTiler(SlabAccumulator):
+    """Centre-crop alternative to SlabAccumulator for sliding-window inference.
+    Rather than blending overlapping predictions, only the central core of each window (the window minus 
+    half the overlap on each side) is kept and copied to its final position, so cores tile the volume without 
+    overlap. Cores of the first and last window along each axis extend to the window edge, so the whole 
+    volume is covered. Planes are passed to the sink unweighted and need no normalisation."""
+    def __init__(self, sink, shape, volume_dims=(64,64,64), stride=(32,32,32), z_start=0, write_from=0):
+        'Initialization'
+        super().__init__(sink, shape, volume_dims=volume_dims, stride=stride, z_start=z_start, write_from=write_from)
+        self.margin = [(int(v)-int(st))//2 for v, st in zip(volume_dims, stride)]
+        self.n_windows = [(int(n)-int(v))//int(st)+1 for n, v, st in zip(self.shape[:3], volume_dims, stride)]
+        
+    def core(self, axis, origin):
+        'Start and end of the core of the window with the given origin along an axis'
+        k = origin // int(self.stride[axis])
+        start = origin if k == 0 else origin + self.margin[axis]
+        end = origin + int(self.volume_dims[axis]) if k == self.n_windows[axis]-1 else origin + self.margin[axis] + int(self.stride[axis])
+        return start, end
+        
+    def add(self, z0, x0, y0, pred, weight=None):
+        'Copy the core of the prediction (Z,X,Y,C) for the window with origin (z0, x0, y0). weight is ignored'
+        (zc0, zc1), (xc0, xc1), (yc0, yc1) = self.core(0, z0), self.core(1, x0), self.core(2, y0)
+        if zc0 < self.z_start or zc1 > self.z_start + self.buffer.shape[0]:
+            raise ValueError("Core of window at z={} falls outside the current slab (z={}:{})".format(
+                z0, self.z_start, self.z_start+self.buffer.shape[0]))
+        self.buffer[zc0-self.z_start:zc1-self.z_start, xc0:xc1, yc0:yc1, :] = pred[zc0-z0:zc1-z0, xc0-x0:xc1-x0, yc0-y0:yc1-y0, :]
+
+class TiffVolume:
+    """Lazy, read-only (Z,X,Y) view of a TIFF or OME-TIFF stack, for inference without conversion to zarr.
+    Uncompressed, contiguous files are memory-mapped. Otherwise pages are decoded when first read and kept 
+    in a small cache (cache_planes), as overlapping windows read the same pages many times.
+    Only one channel is read from multi-channel images. Can be wrapped with dask.array.from_array."""
+    def __init__(self, filename, channel=0, cache_planes=128):
+        'Initialization'
+        import tifffile
+        from functools import lru_cache
+        self.filename = filename
+        self.tif = tifffile.TiffFile(filename)
+        self.tif.filehandle.set_lock(True) # Pages may be read from several threads at once (decoding is not locked)
+        self.series = self.tif.series[0]
+        axes, shape = self.series.axes, self.series.shape
+        
+        # Samples (e.g. RGB) are stored within each page - keep only the selected channel
+        self.sample = None
+        self.n_channels = 1
+        if axes[-1] == 'S':
+            self.sample = channel
+            self.n_channels = shape[-1]
+            axes, shape = axes[:-1], shape[:-1]
+
+        # Leading axes index pages: select the channel and treat any others (e.g. Z, T) as planes
+        self.lead_shape = shape[:-2]
+        self.channel_axis = axes[:-2].find('C')
+        if self.channel_axis >= 0:
+            self.n_channels = self.lead_shape[self.channel_axis]
+        self.channel = channel
+        plane_shape = [n for i, n in enumerate(self.lead_shape) if i != self.channel_axis]
+        self.shape = (int(np.prod(plane_shape)), *shape[-2:])
+        self.plane_shape = tuple(plane_shape)
+        self.dtype = self.series.dtype
+        self.ndim = 3
+        
+        # Memory-map if the image data is stored contiguously and uncompressed
+        self.memmapped = self.series.dataoffset is not None
+        if self.memmapped:
+            array = tifffile.memmap(filename, series=0, mode='r')
+            if self.sample is not None:
+                array = array[..., self.sample]
+            if self.channel_axis >= 0:
+                array = np.take(array, channel, axis=self.channel_axis)
+            self.array = array.reshape(self.shape)
+        self._read_plane = lru_cache(maxsize=cache_planes)(self._decode_plane)
+        
+    def _page_index(self, z):
+        index = list(np.unravel_index(z, self.plane_shape)) if self.plane_shape else []
+        if self.channel_axis >= 0:
+            index.insert(self.channel_axis, self.channel)
+        return int(np.ravel_multi_index(index, self.lead_shape)) if self.lead_shape else 0
+    
+    def _decode_plane(self, z):
+        plane = self.series.asarray(key=self._page_index(z))
+        return plane[..., self.sample] if self.sample is not None else plane
+        
+    def __getitem__(self, key):
+        if self.memmapped:
+            return np.asarray(self.array[key])
+        if not isinstance(key, tuple):
+            key = (key,)
+        zs = range(self.shape[0])[key[0]]
+        if isinstance(zs, int):
+            return self._read_plane(zs)[key[1:]]
+        planes = [self._read_plane(z)[key[1:]] for z in zs]
+        return np.stack(planes) if planes else np.zeros((0, *self.shape[1:]), dtype=self.dtype)[(slice(None), *key[1:])]
+    
+    def close(self):
+        self.tif.close()
+
+    def __getstate__(self):
+        # Pickled (e.g. sent to dask worker processes) as its arguments - the file is opened again on unpickling
+        return {'filename': self.filename, 'channel': self.channel, 'cache_planes': self._read_plane.cache_info().maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+class BackgroundWriter:
+    """Runs write tasks in order on a background thread.
+    Tasks are queued with submit(func, *args). The queue is bounded (queue_depth), so the 
+    producer is held back if writing falls behind. Errors raised by a task are re-raised 
+    on the next submit or on close."""
+    def __init__(self, queue_depth=4):
+        'Initialization'
+        self.queue = queue.Queue(maxsize=max(1, int(queue_depth)))
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                break
+            if self.error is not None:
+                continue # Keep draining the queue so the producer is never blocked
+            func, args = task
+            try:
+                func(*args)
+            except Exception as e:
+                self.error = e
+                
+    def submit(self, func, *args):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((func, args))
+        
+    def close(self):
+        'Wait for all queued tasks to finish'
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+            
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Already failing - stop the thread without masking the original exception
+            self.queue.put(None)
+            self.thread.join()
+        return False
+
+class InferenceLedger:
+    """Small JSON record of finished work for one inference output, saved next to the output zarr store.
+    Records the settings used and how far the output has been written, so that interrupted inference 
+    can be resumed without repeating finished slabs."""
+    def __init__(self, path, settings=None, state=None):
+        'Initialization'
+        self.path = path
+        self.settings = settings
+        self.state = {'finalised_to': None,    # plane up to which labels/softmax have been written
+                      'complete': False}
+        if state is not None:
+            self.state.update(state)
+    
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r') as f:
+            record = json.load(f)
+        return cls(path, settings=record['settings'], state=record['state'])
+        
+    def update(self, **kwargs):
+        self.state.update(kwargs)
+        self.save()
+        
+    def save(self):
+        # Write to temporary file then rename, so an interrupted write never leaves a broken ledger
+        tmp_path = self.path+'.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'settings': self.settings, 'state': self.state}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+class TFLiteModel:
+    """Inference backend running a TFLite model exported by tUbeNet.export_tflite on the CPU.
+    Can be passed to predict_segmentation_dask in place of a keras model: calling it with a batch of 
+    windows (N,Z,X,Y,1) returns softmax predictions (N,Z,X,Y,C) as a numpy array."""
+    def __init__(self, filename, num_threads=None):
+        'Initialization'
+        try:
+            from ai_edge_litert.interpreter import Interpreter
+        except ImportError:
+            Interpreter = tf.lite.Interpreter # Deprecated in recent versions of tensorflow, but still available
+        self.filename = filename
+        self.interpreter = Interpreter(model_path=filename, num_threads=num_threads)
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+        self.input_shape = None
+        
+    def __call__(self, batch):
+        batch = np.asarray(batch)
+        # Tensors are reallocated only when the batch shape changes
+        if batch.shape != self.input_shape:
+            self.interpreter.resize_tensor_input(self.input_details['index'], batch.shape)
+            self.interpreter.allocate_tensors()
+            self.input_shape = batch.shape
+        
+        # Quantise input/dequantise output if the model was exported with integer inputs/outputs
+        scale, zero_point = self.input_details['quantization']
+        if self.input_details['dtype'] != np.float32 and scale:
+            batch = np.round(batch/scale + zero_point)
+        self.interpreter.set_tensor(self.input_details['index'], batch.astype(self.input_details['dtype']))
+        self.interpreter.invoke()
+        
+        preds = self.interpreter.get_tensor(self.output_details['index'])
+        scale, zero_point = self.output_details['quantization']
+        if self.output_details['dtype'] != np.float32 and scale:
+            preds = (preds.astype(np.float32) - zero_point)*scale
+        return preds
+
+class BatchingPredictor:
+    """Shares one model between inference jobs running on several threads (e.g. in serve.py).
+    Can be passed to predict_segmentation_dask in place of a model: each call with a batch of windows (N,Z,X,Y,1) 
+    is queued, and a single model thread combines batches queued by different jobs (with the same window shape)
+    into one call of up to max_batch windows, so the model is kept busy even when each job alone would leave 
+    it idle while reading or writing. Calls wait at most max_wait seconds for other batches to arrive."""
+    def __init__(self, model, max_batch=8, max_wait=0.005):
+        'Initialization'
+        self.model = model
+        self.max_batch = int(max_batch)
+        self.max_wait = max_wait
+        self.n_calls = 0     # model calls made
+        self.n_windows = 0   # windows predicted
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        
+    def __call__(self, batch):
+        future = Future()
+        self.queue.put((np.asarray(batch, dtype=np.float32), future))
+        return future.result()
+    
+    def _run(self):
+        from tUbeNet_functions import predict_batch
+        pending, closing = [], False
+        while pending or not closing:
+            if not pending:
+                request = self.queue.get()
+                if request is None:
+                    closing = True
+                    continue
+                pending.append(request)
+            
+            # Wait briefly for batches from other jobs, until max_batch windows are queued
+            deadline = time.perf_counter() + self.max_wait
+            while not closing and sum(len(batch) for batch, _ in pending) < self.max_batch:
+                try:
+                    request = self.queue.get(timeout=max(0, deadline-time.perf_counter()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    closing = True
+                else:
+                    pending.append(request)
+            
+            # Combine the oldest batch with later batches of the same shape, up to max_batch windows
+            shape = pending[0][0].shape[1:]
+            group, rest, n = [], [], 0
+            for batch, future in pending:
+                if batch.shape[1:] == shape and (not group or n+len(batch) <= self.max_batch):
+                    group.append((batch, future))
+                    n += len(batch)
+                else:
+                    rest.append((batch, future))
+            pending = rest
+            
+            try:
+                preds = predict_batch(self.model, np.concatenate([batch for batch, _ in group]))
+            except Exception as e:
+                for _, future in group:
+                    future.set_exception(e)
+                continue
+            self.n_calls += 1
+            self.n_windows += n
+            
+            # Return each job's share of the predictions
+            i = 0
+            for batch, future in group:
+                future.set_result(preds[i:i+len(batch)])
+                i += len(batch)
+                
+    def close(self):
+        'Finish queued batches and stop the model thread'
+        self.queue.put(None)
+        self.thread.join()
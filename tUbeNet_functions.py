@@ -7,10 +7,20 @@ Developed by Natalie Holroyd (UCL)
 
 #Import libraries
 import os
+import time
+import json
+import shutil
+import hashlib
+import itertools
+import threading
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from skimage import io
 from sklearn.metrics import roc_curve, auc, average_precision_score, precision_recall_curve
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import dask.array as da
 import zarr
 from tqdm import tqdm
@@ -36,6 +46,298 @@ tf.config.optimizer.set_experimental_options({
 })
 
 #---------------------------INFERENCE------------------------------------------------------------------------------------------------------------------------
+HISTOGRAM_BINS = 2**16
+INFERENCE_OVERLAP_FRACTION = 0.1 # Default overlap of inference windows larger than the training window
+
+def histogram_bins(values):
+    """Bin index of each value (NaNs are dropped) for intensity_histogram. Integer types of up to 16 bits have one
+    bin per value. Other values are binned on the top 16 bits of their float32 bit pattern, rearranged to sort 
+    in the same order as the values: bins are about 1% of the value wide, over the whole float range."""
+    values = np.asarray(values).ravel()
+    if values.dtype.kind in 'ui' and values.dtype.itemsize <= 2:
+        return values.astype(np.int64)-np.iinfo(values.dtype).min
+    values = values.astype(np.float32)
+    keys = values[~np.isnan(values)].view(np.uint32)
+    # Flip all bits of negative values and the sign bit of positive values
+    keys = np.where(keys >> 31, ~keys, keys | np.uint32(1 << 31))
+    return (keys >> 16).astype(np.int64)
+
+def bin_values(dtype):
+    'Value at the centre of each bin of histogram_bins (the value itself for 8 and 16 bit integers)'
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'ui' and dtype.itemsize <= 2:
+        return np.arange(HISTOGRAM_BINS, dtype=np.float64)+np.iinfo(dtype).min
+    keys = (np.arange(HISTOGRAM_BINS, dtype=np.uint32) << 16) | np.uint32(1 << 15)
+    keys = np.where(keys >> 31, keys ^ np.uint32(1 << 31), ~keys)
+    with np.errstate(invalid='ignore'):
+        return keys.view(np.float32).astype(np.float64)
+
+def intensity_histogram(img):
+    """Histogram of the intensities of an image (ignoring NaNs), found in one blockwise pass through the image
+    (see histogram_bins). Returns a dict of the counts, the value of each bin and the exact minimum and maximum,
+    from which histogram_range finds the intensity range at any percentiles without reading the image again."""
+    def block_histogram(block):
+        return np.bincount(histogram_bins(block), minlength=HISTOGRAM_BINS).reshape((1,)*block.ndim+(-1,))
+    
+    counts = img.map_blocks(block_histogram, chunks=(1,)*img.ndim+(HISTOGRAM_BINS,), new_axis=img.ndim, 
+                            dtype=np.int64)
+    counts, img_min, img_max = da.compute(counts.sum(axis=tuple(range(img.ndim))), da.nanmin(img), da.nanmax(img))
+    return {'counts': counts, 'values': bin_values(img.dtype), 'min': float(img_min), 'max': float(img_max)}
+
+def histogram_range(histogram, percentiles=(0, 100)):
+    """Intensities at the given percentiles of an intensity_histogram, used to rescale images between 0 and 1.
+    Percentiles other than (0, 100), e.g. (0.5, 99.5), clip outliers such as hot pixels. 0 and 100 give 
+    the exact minimum and maximum, other percentiles are exact for 8 and 16 bit images."""
+    cumulative = np.cumsum(histogram['counts'])
+    bounds = []
+    for p in percentiles:
+        if p <= 0:
+            bounds.append(histogram['min'])
+        elif p >= 100:
+            bounds.append(histogram['max'])
+        else:
+            value = histogram['values'][np.searchsorted(cumulative, p/100*cumulative[-1])]
+            bounds.append(float(np.clip(value, histogram['min'], histogram['max'])))
+    return tuple(bounds)
+
+def image_intensity_range(image_path, percentiles=(0, 100), channel=0):
+    'Intensity range of a TIFF/OME-TIFF stack at the given percentiles (see open_image), in one pass'
+    from tUbeNet_classes import TiffVolume
+    volume = TiffVolume(image_path, channel=channel, cache_planes=0) # Each page is read once
+    chunks = 'auto' if volume.memmapped else (1, *volume.shape[1:])
+    return histogram_range(intensity_histogram(da.from_array(volume, chunks=chunks, asarray=False)), percentiles)
+
+def open_image(image_path, intensity_range=None, channel=0, cache_planes=128, percentiles=(0, 100)):
+    """Opens an image for inference as a lazy (Z,X,Y) dask array.
+    Zarr arrays (e.g. from preprocessing.py) are opened as they are. TIFF/OME-TIFF stacks (.tif/.tiff) are read 
+    directly from the file (see TiffVolume) and rescaled between 0 and 1 on the fly, as in data_preprocessing.
+    intensity_range = (min, max) used for rescaling (values outside are clipped). If None, found from an 
+                      intensity histogram of the whole image, in one pass
+    channel = channel to read from multi-channel TIFFs
+    cache_planes = number of decoded pages kept in memory for compressed TIFFs (at least the window depth)
+    percentiles = percentiles of the image intensities used as the intensity range, if not given"""
+    if not str(image_path).lower().endswith(('.tif', '.tiff')):
+        return da.from_zarr(image_path)
+    
+    from tUbeNet_classes import TiffVolume
+    volume = TiffVolume(image_path, channel=channel, cache_planes=cache_planes)
+    # Memory-mapped files are sliced directly - otherwise read one page per chunk
+    chunks = 'auto' if volume.memmapped else (1, *volume.shape[1:])
+    img = da.from_array(volume, chunks=chunks, asarray=False)
+    
+    # Rescale between 0 and 1
+    if intensity_range is None:
+        print("Finding intensity range of {}".format(image_path))
+        intensity_range = image_intensity_range(image_path, percentiles, channel)
+    img_min, img_max = map(float, intensity_range)
+    img = da.clip((img.astype(np.float32)-img_min)/max(img_max-img_min, 1e-8), 0, 1)
+    return img.astype(np.float32)
+
+def open_roi(roi, image_shape):
+    """Region of interest for inference, given either as a voxel bounding box ((z0, z1), (x0, x1), (y0, y1)), 
+    or as a mask with the same shape as the image (path to a zarr array, or an array), nonzero inside the region.
+    Returns the bounding box of the region (clipped to the image) and the mask as a boolean dask array 
+    (None if a bounding box was given)."""
+    if isinstance(roi, str) or getattr(roi, 'ndim', 0) >= 3:
+        mask = da.from_zarr(roi) if isinstance(roi, str) else da.asarray(roi)
+        if mask.ndim == 4 and mask.shape[-1] == 1:
+            mask = mask[..., 0]
+        if tuple(mask.shape) != tuple(image_shape):
+            raise ValueError("Region of interest mask with shape {} does not match image with shape {}".format(
+                mask.shape, tuple(image_shape)))
+        mask = mask.astype(bool)
+        # Bounding box from the projection of the mask onto each axis (one pass through the mask)
+        projections = da.compute(mask.any(axis=(1, 2)), mask.any(axis=(0, 2)), mask.any(axis=(0, 1)))
+        if not projections[0].any():
+            raise ValueError("Region of interest mask is empty")
+        box = [(int(np.argmax(p)), int(len(p)-np.argmax(p[::-1]))) for p in projections]
+    else:
+        mask = None
+        box = [(max(0, int(b[0])), min(int(n), int(b[1]))) for b, n in zip(roi, image_shape)]
+        if len(box) != 3 or any(b0 >= b1 for b0, b1 in box):
+            raise ValueError("Region of interest {} does not overlap image with shape {}".format(roi, tuple(image_shape)))
+    return box, mask
+
+def hamming_window(volume_dims):
+    """Blending window used to combine overlapping predictions.
+    Returns one 1D Hamming profile per axis (Z,X,Y), each normalised to a maximum of 1.
+    The 3D window is the outer product of the three profiles."""
+    profiles = []
+    for dim in volume_dims:
+        w = general_hamming(int(dim), 0.75)
+        profiles.append(w/w.max())
+    return profiles
+
+def blending_weights(length, window, stride, n_windows):
+    """Sum of a 1D blending window placed every 'stride' pixels, n_windows times, along an axis of the given length.
+    As the 3D window is separable and windows lie on a regular grid, the summed 3D weights used to normalise
+    the blended prediction are the outer product of the profiles for each axis."""
+    profile = np.zeros(int(length), dtype=np.float64)
+    for k in range(int(n_windows)):
+        profile[k*stride:k*stride+len(window)] += window
+    return profile
+				
+def auto_pad(img, volume_dims, stride):
+    """Reflect-pads a 3D dask array so that windows of volume_dims, placed every stride pixels,
+    cover the whole image with a margin of at least half a window on each side.
+    Returns the padded array and the (before, after) pad widths for each axis."""
+    img_shape = np.array(img.shape)
+    volume_dims = np.array(volume_dims)
+
+    pad_widths = []
+    new_shape = []
+
+    for shape_i, dim_i, stride_i in zip(img_shape, volume_dims, stride):
+        # Number of strides needed to cover full image volume
+        target_size = int(np.ceil((shape_i-dim_i)/stride_i)*stride_i+dim_i)
+
+        total_pad = target_size-shape_i
+
+        # Pad must be at least half volume_dims to avoid boundary artefact
+        half = dim_i//2
+        before = max(half, total_pad//2) # pad on either side of image
+        after = max(total_pad-before, half)
+        
+        # Extend padding after the image if the last window would end before the image does
+        n_windows = int(np.ceil(max(before+shape_i-dim_i, 0)/stride_i))+1
+        after = max(after, (n_windows-1)*stride_i+dim_i-before-shape_i)
+
+        pad_widths.append((before, after)) # (Before, After) in each dimension
+        new_shape.append(shape_i + before + after)
+
+    padded = da.pad(img, pad_widths, mode='reflect')
+    #print(f"Padded from {img.shape} to {tuple(new_shape)}") #Debugging
+    return padded, pad_widths
+
+def zarr_compressors(codec='default', level=None):
+    """Compressors argument for a zarr array, given a codec name:
+    'default' (zarr default), 'none' (uncompressed), 'zstd', 'gzip', 
+    'blosc-zstd' or 'blosc-lz4' (Blosc with bitshuffle).
+    level = compression level (optional, codec default if None)"""
+    from zarr.codecs import BloscCodec, ZstdCodec, GzipCodec
+    
+    codec = 'default' if codec is None else str(codec).lower()
+    if codec == 'default':
+        return 'auto'
+    elif codec == 'none':
+        return None
+    elif codec == 'zstd':
+        return [ZstdCodec(level=3 if level is None else int(level))]
+    elif codec == 'gzip':
+        return [GzipCodec(level=5 if level is None else int(level))]
+    elif codec in ('blosc-zstd', 'blosc-lz4'):
+        return [BloscCodec(cname=codec.split('-')[1], clevel=5 if level is None else int(level), shuffle='bitshuffle')]
+    else:
+        raise ValueError("Compressor '{}' not recognised. Choose from 'default', 'none', 'zstd', 'gzip', "
+                         "'blosc-zstd' or 'blosc-lz4'".format(codec))
+
+def create_prediction_arrays(root, shape, volume_dims=(64, 64, 64), n_classes=2, softmax_dtype='float32', 
+                             save_softmax=True, compressors='auto'):
+    """Creates (overwriting) the 'labels' and, if save_softmax is True, 'softmax' arrays in an output zarr group. 
+    Softmax can be stored as float32, float16 or uint8 - uint8 values are probabilities scaled to 0-255, 
+    with the scale recorded in the array attributes.
+    Returns labels and softmax arrays (softmax is None if not saved)."""
+    labels = root.create_dataset("labels", shape=shape, chunks=tuple(volume_dims), dtype="uint8", 
+                                 compressors=compressors, overwrite=True)
+    softmax = None
+    if save_softmax:
+        if softmax_dtype not in ('float32', 'float16', 'uint8'):
+            raise ValueError("softmax_dtype must be 'float32', 'float16' or 'uint8'")
+        softmax = root.create_dataset("softmax", shape=(*shape, n_classes), chunks=(*volume_dims, n_classes), 
+                                      dtype=softmax_dtype, compressors=compressors, overwrite=True)
+        softmax.attrs["scale"] = 1/255 if softmax_dtype == 'uint8' else 1.0
+    return labels, softmax
+
+def quantise_softmax(probs, softmax_dtype='float32'):
+    """Converts softmax probabilities to the dtype used for storage (see create_prediction_arrays)"""
+    if softmax_dtype == 'uint8':
+        return np.round(np.clip(probs, 0, 1)*255).astype(np.uint8)
+    return probs.astype(softmax_dtype)
+
+def export_labels_bigtiff(labels, path):
+    """Exports a (Z,X,Y) labels array as a BigTIFF 3D volume, slice-by-slice to handle very large images"""
+    with tiff.TiffWriter(path, bigtiff=True) as tw:
+        for z in tqdm(range(labels.shape[0]), desc="Export BigTIFF", unit="slice"):
+            seg_slice = np.array(labels[z, :, :])  # bring one 2D slice to RAM
+            tw.write(seg_slice, photometric="minisblack", metadata=None)
+
+def predict_batch(model, batch):
+    """Softmax predictions (N,Z,X,Y,C) for a batch of windows (N,Z,X,Y,1), using either a keras model or 
+    a function returning predictions as an array (e.g. from tUbeNet.inference_function)"""
+    if isinstance(model, tf.keras.Model):
+        return model.predict(batch, batch_size=len(batch), verbose=0)
+    return np.asarray(model(batch))
+
+def window_statistics(img, volume_dims, stride, n_windows, rows=None, downsample=4):
+    """
+    Cheap intensity statistics for every sliding window, used to find windows containing only background.
+    Statistics are computed on a downsampled copy of the image (every 'downsample'th pixel), over a grid of 
+    cells one stride wide, one slab of cells at a time. Each window then combines the cells it covers.
+    rows = optional (start, stop) range of windows in the z axis to compute.
+    Returns a dictionary of 'max', 'mean' and 'std' arrays with shape n_windows (windows outside rows are NaN).
+    """
+    stride = [int(s) for s in stride]
+    downsample = max(1, min(int(downsample), *stride)) # Every cell must contain at least one pixel
+    small = img[::downsample, ::downsample, ::downsample]
+    
+    # Number of cells covered by one window, and first downsampled pixel of each cell along each axis
+    n_cover = [-(-int(d)//s) for d, s in zip(volume_dims, stride)]
+    n_cells = [int(n)+m-1 for n, m in zip(n_windows, n_cover)]
+    starts = [np.minimum(-(-np.arange(n)*s//downsample), length-1) 
+              for n, s, length in zip(n_cells, stride, small.shape)]
+    
+    if rows is None:
+        rows = (0, n_windows[0])
+    cells_z = range(rows[0], min(rows[1]+n_cover[0]-1, n_cells[0]))
+    
+    cell_max = np.full(n_cells, -np.inf)
+    cell_sum = np.zeros(n_cells)
+    cell_sumsq = np.zeros(n_cells)
+    cell_count = np.zeros(n_cells)
+    for kz in tqdm(cells_z, desc="Window statistics"):
+        z1 = starts[0][kz+1] if kz+1 < n_cells[0] else small.shape[0]
+        z1 = max(z1, starts[0][kz]+1)
+        block = small[starts[0][kz]:z1].compute().astype(np.float64)
+        
+        # Reduce over cells along x and y
+        cell_max[kz] = np.maximum.reduceat(np.maximum.reduceat(block.max(axis=0), starts[1], axis=0), starts[2], axis=1)
+        cell_sum[kz] = np.add.reduceat(np.add.reduceat(block.sum(axis=0), starts[1], axis=0), starts[2], axis=1)
+        cell_sumsq[kz] = np.add.reduceat(np.add.reduceat((block**2).sum(axis=0), starts[1], axis=0), starts[2], axis=1)
+        ones = np.ones(block.shape[1:])*block.shape[0]
+        cell_count[kz] = np.add.reduceat(np.add.reduceat(ones, starts[1], axis=0), starts[2], axis=1)
+        
+    # Combine cells covered by each window
+    def combine(cells, reduce):
+        view = np.lib.stride_tricks.sliding_window_view(cells, n_cover)[:n_windows[0], :n_windows[1], :n_windows[2]]
+        return reduce(view, axis=(3, 4, 5))
+    
+    win_max = combine(cell_max, np.max)
+    win_count = np.maximum(combine(cell_count, np.sum), 1)
+    win_mean = combine(cell_sum, np.sum)/win_count
+    win_std = np.sqrt(np.maximum(combine(cell_sumsq, np.sum)/win_count - win_mean**2, 0))
+    
+    # Windows outside the requested rows were not measured
+    measured = np.zeros(n_windows, dtype=bool)
+    measured[rows[0]:rows[1]] = True
+    stats = {'max': win_max, 'mean': win_mean, 'std': win_std}
+    for key in stats:
+        stats[key] = np.where(measured, stats[key], np.nan)
+    
+    return stats
+
+def prefetch(tasks, read_fn, n_readers=2, queue_depth=4):
+    """Yields (task, read_fn(*task)) for each task in order, while a pool of n_readers threads 
+    reads up to queue_depth tasks ahead."""
+    with ThreadPoolExecutor(max_workers=max(1, int(n_readers))) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append((task, pool.submit(read_fn, *task)))
+            if len(pending) > queue_depth:
+                task, future = pending.popleft()
+                yield task, future.result()
+        while pending:
+            task, future = pending.popleft()
+            yield task, future.result()
 				
 def predict_segmentation_dask(
     model,
@@ -46,16 +348,68 @@ def predict_segmentation_dask(
     n_classes=2,                # softmax classes produced by model
     export_bigtiff=None,        # e.g. "/path/dataset_pred.tif" to export 3D TIFF (optional)
     preview=False,              # Preview segmentation for every slab of subvolumes processed in the z axis
+    batch_size=1,               # Number of windows passed to the model in a single predict call
+    pipeline=False,             # Overlap reading, inference and writing using background threads
+    n_readers=2,                # Number of threads prefetching windows from the image (pipeline mode)
+    queue_depth=4,              # Maximum number of batches waiting to be processed/written (pipeline mode)
+    z_range=None,               # (z_start, z_stop) - only predict these planes of the image, e.g. for one shard of a larger job
+    background_threshold=None,  # Skip windows where background_stat of the image is below this value (None = predict all windows)
+    background_stat='max',      # Intensity statistic used to find background windows: 'max', 'mean' or 'std'
+    stats_downsample=4,         # Downsampling factor of the image copy used to compute window statistics
+    resume=False,               # Continue an interrupted run recorded in the ledger next to out_store
+    save_softmax=True,          # Save softmax probabilities as well as labels (False = labels only)
+    softmax_dtype='float32',    # Storage type of softmax: 'float32', 'float16' or 'uint8' (probabilities scaled to 0-255)
+    compressor='default',       # Compressor for output arrays (see zarr_compressors), e.g. 'blosc-zstd'
+    compression_level=None,     # Compression level (optional)
+    intensity_range=None,       # (min, max) used to rescale TIFF images between 0 and 1 (found from the image if None)
+    intensity_percentiles=(0, 100), # Percentiles of TIFF image intensities used as the intensity range, if not given
+    stitching='blend',          # 'blend' (Hamming-weighted blending of overlapping windows) or 'crop' (keep window centres only)
+    progress=None,              # Optional function called as progress(n_done, n_total) after each batch of windows
+    screener=None,              # Optional screening network (see tUbeNet.build_screener) run on each batch before the model
+    screening_threshold=0.1,    # Windows the screener scores below this vessel probability are not passed to the model
+    roi=None,                   # Region of interest: voxel bounding box ((z0, z1), (x0, x1), (y0, y1)) or mask (see open_roi)
+    roi_output='crop',          # 'crop' (outputs cover the ROI bounding box only), 'full' (full-size outputs, written in the ROI only)
+                                # or 'patch' (update the ROI in existing full-size outputs, see update_segmentation_dask)
 ):
     """
     Sliding-window inference with smooth blending.
-    Writes two Zarr datasets on disk during accumulation: 'sum' and 'wsum'.
-    Final result is written as 'labels' and 'softmax'.
+    Windows are gathered into batches of batch_size (within each slab in the z axis) so that 
+    the per-call overhead of model.predict is shared between several patches.
+    Predictions are accumulated in a rolling in-memory buffer one slab at a time (see SlabAccumulator).
+    As soon as a slab is finished it is normalised and written to 'labels' and 'softmax' (and to the BigTIFF, 
+    on a background thread), so every plane is read from memory and written to disk exactly once.
+    The summed blending weights are not stored: they are computed per slab from 1D profiles (see blending_weights).
+    With stitching='crop', overlapping predictions are not blended: only the central core of each window is kept 
+    and copied to the output (see SlabTiler), so no weighting or normalisation is needed.
+    In pipeline mode, a pool of reader threads prefetches batches into a bounded queue and a writer thread
+    applies predictions to the accumulator, hiding I/O latency behind model inference.
+    Final result is written as 'labels' and 'softmax'. To reduce storage, softmax can be quantised to float16 or
+    uint8, or not saved at all (labels only), and the compressor used for both arrays can be chosen.
+    If z_range is given, only windows overlapping those planes (plus the halo needed for blending) are processed,
+    and 'labels'/'softmax' hold planes z_start:z_stop only. The result is identical to the same planes of a 
+    prediction on the whole image (see plan_inference_shards and merge_inference_shards).
+    If background_threshold is set, windows whose intensity statistic (computed on a downsampled copy of the image,
+    see window_statistics) falls below the threshold are not passed to the model - a constant background 
+    prediction is blended in their place.
+    With a screener (two-stage cascade), each batch is first scored by the small screening network, and only windows
+    with a vessel probability of at least screening_threshold are passed to the full model. Other windows are filled 
+    with background in the same way.
+    If roi is given, only windows overlapping the region of interest (a bounding box, or the nonzero voxels of a mask)
+    are predicted, on the same grid of windows as for the whole image, so runtime scales with the size of the region
+    and predictions inside it are identical to those for the whole image. Outputs either cover the bounding box of 
+    the region (roi_output='crop') or the whole image (roi_output='full', where chunks outside the region are never 
+    written). The position of the output in the image is stored in the 'offset' attribute. With a mask, voxels 
+    outside the mask are set to zero in both outputs. With roi_output='patch', existing full-size outputs in out_store
+    are updated in place: only voxels inside the region are overwritten (see update_segmentation_dask).
+    Progress is recorded in a small JSON ledger next to the output store (out_store + "_ledger.json"). 
+    With resume=True, an interrupted run continues from the last complete slab instead of starting again.
+    image_path can also be a TIFF/OME-TIFF stack, which is read directly and rescaled on the fly (see open_image).
     Optionally, writes a BigTIFF 3D volume without holding everything in RAM.
     """
 
     # Open image using Dask array and check dimensions
-    img = da.from_zarr(image_path) # shape (Z,X,Y) or (Z,X,Y,1)
+    img = open_image(image_path, intensity_range=intensity_range, cache_planes=2*volume_dims[0], 
+                     percentiles=intensity_percentiles) # shape (Z,X,Y) or (Z,X,Y,1)
     if img.ndim == 4 and img.shape[-1] == 1:
         img = img[..., 0]
     assert img.ndim == 3, "Expected (Z,X,Y) image"
@@ -67,61 +421,139 @@ def predict_segmentation_dask(
     # Check for sensible overlap dimensions
     if any(stride<0):
         raise ValueError("overlap must be less than volume_dims on each axis")
+    if stitching not in ('blend', 'crop'):
+        raise ValueError("stitching must be 'blend' or 'crop'")
+    if roi_output not in ('crop', 'full', 'patch'):
+        raise ValueError("roi_output must be 'crop', 'full' or 'patch'")
+    patch = roi is not None and roi_output == 'patch'
         
-    def auto_pad(img, volume_dims, stride):
-        img_shape = np.array(img.shape)
-        volume_dims = np.array(volume_dims)
-        
-        pad_widths = []
-        new_shape = []
-        
-        for shape_i, dim_i, stride_i in zip(img_shape, volume_dims, stride):
-            # Number of strides needed to cover full image volume
-            target_size = int(np.ceil((shape_i-dim_i)/stride_i)*stride_i+dim_i)
-
-            total_pad = target_size-shape_i
-            
-            # Pad must be at least half volume_dims to avoid boundary artefact
-            half = dim_i//2
-            before = max(half, total_pad//2) # pad on either side of image
-            after = max(total_pad-before, half)
-            
-            pad_widths.append((before, after)) # (Before, After) in each dimension
-            new_shape.append(shape_i + before + after)
-        
-        padded = da.pad(img, pad_widths, mode='reflect')
-        #print(f"Padded from {img.shape} to {tuple(new_shape)}") #Debugging
-        return padded, pad_widths
-       
     # Pad image to avoid boundary effects and allow patches to cover whole image
     img, pad_widths = auto_pad(img, volume_dims, stride)
-
-    # Prepare output Zarr stores
-    # Accumulates weighted sum of softmax outputs, and summed weights from hann filter (for normalising)
-    root = zarr.open(out_store, mode="w")
-    sum_arr = root.create_dataset("sum", shape=(*img.shape, n_classes), chunks=(*volume_dims, n_classes),
-                                  dtype="float32")
-    wsum_arr = root.create_dataset("wsum", shape=(*img.shape, 1), chunks=(*volume_dims, 1),
-                                   dtype="float32")
+    
+    # Region of interest: the padded image is cropped in x and y to the windows overlapping the region, keeping the
+    # grid of windows used for the whole image (the z axis is limited to these windows further down, as for z_range)
+    roi_box, roi_mask = [(0, Z), (0, X), (0, Y)], None
+    if roi is not None:
+        roi_box, roi_mask = open_roi(roi, (Z, X, Y))
+    crop = [slice(None)]
+    for ax in (1, 2):
+        pad, s, v = int(pad_widths[ax][0]), int(stride[ax]), int(volume_dims[ax])
+        first = max(0, (pad+roi_box[ax][0]-v)//s + 1)
+        last = min((img.shape[ax]-v)//s + 1, -(-(pad+roi_box[ax][1])//s))
+        crop.append(slice(first*s, (last-1)*s+v))
+    img = img[tuple(crop)]
+    (x_start, x_stop), (y_start, y_stop) = roi_box[1], roi_box[2]
 
     # Compute Hann window for blending
-    wz, wx, wy = general_hamming(volume_dims[0],0.75), general_hamming(volume_dims[1],0.75), general_hamming(volume_dims[2],0.75)
+    wz, wx, wy = hamming_window(volume_dims)
     w_patch = wz[:, None, None] * wx[None, :, None] * wy[None, None, :]
-    w_patch /= (w_patch.max() + 1e-8) # Normalise to max 1
     w_patch = w_patch.astype(np.float32)[...,None] # (Z,X,Y,1) 
 
     # Compute sliding window coordinates
     windows = da.lib.stride_tricks.sliding_window_view(img, volume_dims)[::stride[0], 
                                     ::stride[1], ::stride[2]]
     #print("windows shape:", windows.shape) #debugging
+    
+    # Summed blending weights along each axis, used in place of a full-volume array of weights
+    wz_sum = blending_weights(img.shape[0], wz, stride[0], windows.shape[0])
+    wx_sum = blending_weights(img.shape[1], wx, stride[1], windows.shape[1])
+    wy_sum = blending_weights(img.shape[2], wy, stride[2], windows.shape[2])
 
+    # Range of planes to predict (unpadded coordinates)
+    z_start, z_stop = roi_box[0]
+    if z_range is not None:
+        z_start, z_stop = max(z_start, int(z_range[0])), min(z_stop, int(z_range[1]))
+        if z_start >= z_stop:
+            raise ValueError("z_range {} does not overlap image with {} planes (or region of interest {})".format(
+                z_range, Z, roi_box[0]))
+    
+    # Slabs of windows that contribute to these planes: first slab ending after z_start, up to the last slab starting before z_stop
+    pz = int(pad_widths[0][0])
+    row_start = max(0, (pz+z_start-volume_dims[0])//stride[0] + 1)
+    row_stop = min(windows.shape[0], -(-(pz+z_stop)//stride[0]))
+    
+    # Ledger recording finished work next to the output store, used to resume interrupted inference
+    from tUbeNet_classes import InferenceLedger
+    ledger_path = str(out_store).rstrip("/\\")+"_ledger.json"
+    settings = {"image_path": str(image_path),
+                "image_shape": [Z, X, Y],
+                "volume_dims": [int(v) for v in volume_dims],
+                "overlap": [int(o) for o in overlap],
+                "n_classes": int(n_classes),
+                "z_range": [z_start, z_stop],
+                "save_softmax": bool(save_softmax),
+                "softmax_dtype": str(softmax_dtype),
+                "stitching": stitching}
+    if screener is not None:
+        settings["screening_threshold"] = float(screening_threshold)
+    if roi is not None:
+        settings["roi"] = {"box": [list(b) for b in roi_box], 
+                           "mask": roi if isinstance(roi, str) else None, 
+                           "output": roi_output}
+    resuming = False
+    if resume and os.path.isfile(ledger_path) and os.path.exists(out_store):
+        ledger = InferenceLedger.load(ledger_path)
+        if ledger.settings != settings:
+            raise ValueError("Cannot resume: inference settings differ from those recorded in {}. "
+                             "Run without resume to start again.".format(ledger_path))
+        resuming = True
+        if ledger.state["complete"]:
+            print("Inference already complete for {}".format(out_store))
+            root = zarr.open(out_store, mode="r")
+            return root["softmax"] if save_softmax else root["labels"], os.path.join(out_store, "segmentation")
+        print("Resuming inference from {}".format(ledger_path))
+    else:
+        ledger = InferenceLedger(ledger_path, settings=settings)
+
+    # Prepare output Zarr store (or reopen if resuming part way through)
+    root = zarr.open(out_store, mode="r+" if resuming or patch else "w")
+    if "sum" in root:
+        del root["sum"] # Left behind by older versions, which stored the weighted sum on disk
+    # Outputs cover planes z_start:z_stop and the region of interest (or the whole image, for roi_output='full')
+    if roi is not None and roi_output in ('full', 'patch'):
+        out_origin, out_shape = (0, 0, 0), (Z, X, Y)
+    else:
+        out_origin, out_shape = (z_start, x_start, y_start), (z_stop-z_start, x_stop-x_start, y_stop-y_start)
+    if patch and not ("labels" in root and root["labels"].shape == out_shape and ("softmax" in root or not save_softmax)):
+        raise ValueError("Cannot patch {}: no existing outputs covering the whole image".format(out_store))
+    if (resuming or patch) and "labels" in root and ("softmax" in root or not save_softmax):
+        labels = root["labels"]
+        softmax = root["softmax"] if save_softmax else None
+    else:
+        labels, softmax = create_prediction_arrays(root, out_shape, volume_dims=volume_dims, 
+                                                   n_classes=n_classes, softmax_dtype=softmax_dtype, 
+                                                   save_softmax=save_softmax, 
+                                                   compressors=zarr_compressors(compressor, compression_level))
+    root.attrs["z_range"] = [z_start, z_stop]
+    root.attrs["offset"] = list(out_origin)
+    if roi is not None and not patch:
+        root.attrs["roi"] = [list(b) for b in roi_box]
+    ledger.save()
+    
+    # When resuming, restart from the first slab contributing to planes not yet written 
+    # (planes already written are not rewritten)
+    finalise_from = z_start
+    if ledger.state["finalised_to"] is not None:
+        finalise_from = ledger.state["finalised_to"]
+        row_start = max(row_start, (pz+finalise_from-volume_dims[0])//stride[0] + 1)
+    if finalise_from >= z_stop:
+        row_start = row_stop
+
+    # Windows overlapping a region of interest mask (all windows otherwise)
+    selected = np.ones(windows.shape[:3], dtype=bool)
+    if roi_mask is not None and row_start < row_stop:
+        mask = da.pad(roi_mask.astype(np.float32), pad_widths, mode='constant')[tuple(crop)]
+        selected = window_statistics(mask, volume_dims, stride, windows.shape[:3], 
+                                     rows=(row_start, row_stop), downsample=1)['max'] > 0
+    
     # Total patches for progress bar
-    total_patches = windows.shape[0]*windows.shape[1]*windows.shape[2]
+    total_patches = int(selected[row_start:row_stop].sum())
 
     # Preview
     def plot_preview(original, pred, z, out_store):
-        
-        fig, axs = plt.subplots(1, 2, figsize=(10, 5))
+        # Figure is created without pyplot so previews can be saved from the writer thread
+        fig = Figure(figsize=(10, 5))
+        axs = fig.subplots(1, 2)
         axs[0].imshow(original, cmap="gray")
         axs[0].set_title(f"Input z={z}")
         axs[0].axis("off")
@@ -129,169 +561,829 @@ def predict_segmentation_dask(
         axs[1].imshow(pred, cmap="viridis")
         axs[1].set_title(f"Prediction z={z}")
         axs[1].axis("off")
-        plt.tight_layout()
+        fig.tight_layout()
         fig.savefig(os.path.join(out_store,'preview_z'+str(z)+'.png'))
         
 
-    # Inference step - iterate through windows and blend with weighted sum
-    step_i = 0
-    with tqdm(total=total_patches, desc="Inference", unit="patch") as pbar:
-        for zi in range(windows.shape[0]):
-            # Define position within image (z-axis)
-            z0 = zi * stride[0]
-            z1 = z0 + volume_dims[0]
+    # Summed weights cropped to the original image (or region of interest), used to normalise finished planes
+    px = pad_widths[1][0] + x_start - crop[1].start
+    py = pad_widths[2][0] + y_start - crop[2].start
+    nx, ny = x_stop-x_start, y_stop-y_start
+    wz_crop, wx_crop, wy_crop = wz_sum[pz:pz+Z], wx_sum[px:px+nx], wy_sum[py:py+ny]
+    
+    # Optional BigTIFF export, written page by page on a background thread as planes are finished.
+    # A TIFF cannot be appended to after an interruption, so when resuming it is exported from labels at the end
+    # (as are full-size outputs of a region of interest).
+    from tUbeNet_classes import SlabAccumulator, BackgroundWriter
+    stream_tiff = bool(export_bigtiff) and finalise_from == z_start and out_shape == (z_stop-z_start, nx, ny) and not patch
+    if stream_tiff:
+        tiff_file = tiff.TiffWriter(export_bigtiff, bigtiff=True)
+        tiff_writer = BackgroundWriter(queue_depth=queue_depth)
+        
+    def write_pages(seg):
+        for seg_slice in seg:
+            tiff_file.write(seg_slice, photometric="minisblack", metadata=None)
+    
+    # Finished planes are normalised as soon as they leave the accumulator, and held until they fill
+    # whole output chunks in the z axis so that each chunk is written once
+    pending = {"z0": finalise_from, "probs": []}
+    
+    def write_outputs(z0, probs):
+        z1 = z0 + probs.shape[0]
+        seg = np.argmax(probs, axis=-1).astype(np.uint8)
+        oz, ox, oy = out_origin
+        region = (slice(z0-oz, z1-oz), slice(x_start-ox, x_stop-ox), slice(y_start-oy, y_stop-oy))
+        if save_softmax:
+            probs = quantise_softmax(probs, softmax_dtype)
+        if patch and roi_mask is not None:
+            # Keep existing values outside the mask
+            inside = np.asarray(roi_mask[z0:z1, x_start:x_stop, y_start:y_stop])
+            seg = np.where(inside, seg, labels[region])
+            if save_softmax:
+                probs = np.where(inside[..., None], probs, softmax[region])
+        if save_softmax:
+            softmax[region]  =  probs
+        labels[region] = seg
+        if stream_tiff:
+            tiff_writer.submit(write_pages, seg)
+        ledger.update(finalised_to=int(z1))
+    
+    def finalise(zp0, planes):
+        # Crop padding (and planes outside z_range or the region of interest) from the finished planes, in unpadded coordinates
+        z0 = max(zp0-pz, z_start)
+        z1 = min(zp0+planes.shape[0]-pz, z_stop)
+        if z1 <= z0:
+            return
+        slab_sum = planes[z0+pz-zp0:z1+pz-zp0, px:px+nx, py:py+ny, :]  # (N,X,Y,C)
+        
+        if stitching == 'crop':
+            # Window cores are copied unweighted, so need no normalisation
+            probs = np.array(slab_sum, dtype=np.float32)
+        else:
+            # Summed weights for these planes from the outer product of axis profiles
+            slab_w = wz_crop[z0:z1, None, None] * wx_crop[None, :, None] * wy_crop[None, None, :]
+            slab_w = slab_w[..., None].astype(np.float32)                   # (N,X,Y,1)
+            probs = np.where(slab_w > 0, slab_sum / np.maximum(slab_w, 1e-8), 0.0).astype(np.float32)
+        if roi_mask is not None and not patch:
+            probs *= np.asarray(roi_mask[z0:z1, x_start:x_stop, y_start:y_stop])[..., None]
+        pending["probs"].append(probs)
+        
+        # Write all whole chunks now complete (or everything, at the end of the range)
+        chunk_end = z_stop if z1 == z_stop else out_origin[0] + ((z1-out_origin[0])//volume_dims[0])*volume_dims[0]
+        if chunk_end > pending["z0"]:
+            probs = np.concatenate(pending["probs"])
+            n = chunk_end - pending["z0"]
+            write_outputs(pending["z0"], probs[:n])
+            pending["z0"], pending["probs"] = chunk_end, [probs[n:]]
+    
+    # In-memory accumulator (or tiler of window cores) for the current slab of windows
+    if stitching == 'crop':
+        from tUbeNet_classes import SlabTiler
+        accumulator = SlabTiler(finalise, (*img.shape, n_classes), volume_dims=volume_dims, stride=stride, 
+                                z_start=row_start*stride[0], write_from=pz+finalise_from)
+    else:
+        accumulator = SlabAccumulator(finalise, (*img.shape, n_classes), volume_dims=volume_dims, stride=stride, 
+                                      z_start=row_start*stride[0], write_from=pz+finalise_from)
+    # Planes finished once a slab of windows is complete - with cropping, up to the end of the slab's cores
+    core_margin = (volume_dims[0]-stride[0])//2 if stitching == 'crop' else 0
+    
+    # Optional pre-pass: find windows containing only background from cheap intensity statistics
+    if background_threshold is not None and row_start < row_stop:
+        print("Computing window intensity statistics to find background")
+        stats = window_statistics(img, volume_dims, stride, windows.shape[:3], 
+                                  rows=(row_start, row_stop), downsample=stats_downsample)
+        background = stats[background_stat] < background_threshold
+    else:
+        background = np.zeros(windows.shape[:3], dtype=bool)
+    
+    # Constant prediction (probability 1 for class 0) blended in place of skipped windows
+    background_patch = np.zeros((*volume_dims, n_classes), dtype=np.float32)
+    background_patch[..., 0] = 1
+    
+    # List batches of windows in the order they are processed, as (z index, list of (x0, y0) positions, 
+    # list of skipped background (x0, y0) positions). Batches do not span more than one slab in the z axis,
+    # and every slab has at least one (possibly empty) batch. Skipped windows are listed with the first batch in their slab.
+    batches = []
+    for zi in range(row_start, row_stop):
+        slab_coords = [(xi * stride[1], yi * stride[2]) for xi in range(windows.shape[1]) for yi in range(windows.shape[2]) 
+                       if selected[zi, xi, yi] and not background[zi, xi, yi]]
+        skipped_coords = [(xi * stride[1], yi * stride[2]) for xi in range(windows.shape[1]) for yi in range(windows.shape[2]) 
+                          if selected[zi, xi, yi] and background[zi, xi, yi]]
+        batches.append((zi, slab_coords[:batch_size], skipped_coords))
+        for b0 in range(batch_size, len(slab_coords), batch_size):
+            batches.append((zi, slab_coords[b0:b0+batch_size], []))
+    
+    def read_batch(zi, batch_coords, skipped_coords):
+        if not batch_coords:
+            return None
+        # Read patches (compute only these slices, in a single dask call)
+        z0 = zi * stride[0]
+        patches = da.compute(*[img[z0:z0+volume_dims[0], x0:x0+volume_dims[1], y0:y0+volume_dims[2]] 
+                               for x0, y0 in batch_coords])
+        batch = np.stack(patches).astype(np.float32, copy=False)
+        return batch[...,None] # Reshape to (N,Z,X,Y,C)
+    
+    def write_batch(zi, batch_coords, preds):
+        for (x0, y0), pred in zip(batch_coords, preds):
+            # Add weighted prediciton and weighs to accumlator in correct position
+            accumulator.add(zi * stride[0], x0, y0, pred, w_patch)
+            
+    def write_background(zi, skipped_coords):
+        for x0, y0 in skipped_coords:
+            accumulator.add(zi * stride[0], x0, y0, background_patch, w_patch)
+    
+    def finish_slab(zi):
+        z0 = zi * stride[0]
+        z1 = z0 + volume_dims[0]
+        if preview and z0>0 and z1<img.shape[0]: # Produce preview if flag present AND this is not the first/last slab (avoids printing padded region) 
+            # Normalize current accum/weights to preview
+            z_mid_slice = z0 + (volume_dims[0] // 2)
+            # Read single slice from the in-memory slab
+            preview_sum = accumulator.read_plane(z_mid_slice)
+            
+            # Weights accumulated so far - only slabs up to zi have contributed to this slice
+            if stitching == 'crop':
+                preview_w = np.ones((1, 1, 1), dtype=np.float32)
+            else:
+                wz_partial = blending_weights(img.shape[0], wz, stride[0], zi+1)[z_mid_slice]
+                preview_w = (wz_partial * wx_sum[:, None] * wy_sum[None, :])[..., None]
+            
+            # Normalise to accumulated weights, avoid division by zero. preview_pred shape is (X Y C).
+            preview_pred = np.where(preview_w > 0, preview_sum/ np.maximum(preview_w, 1e-8), 0.0)
             
-            for xi in range(windows.shape[1]):
-                # Define position within image (x-axis)
-                x0 = xi * stride[1]
-                x1 = x0 + volume_dims[1]
+            # If n_classes>2 reverse OHE. otherwise print softmax output for foreground class
+            if n_classes >2:
+                preview_pred = np.argmax(preview_pred, axis=-1)
+            else:
+                preview_pred = preview_pred[...,1]
                 
-                for yi in range(windows.shape[2]):
-                    # Define position within image (y-axis)
-                    y0 = yi * stride[2]
-                    y1 = y0 + volume_dims[2]
-                    
-                    # Read patch (compute only this slice)
-                    patch = windows[zi, xi, yi].compute().astype(np.float32, copy=False)
-                    patch = patch[None,...,None] # Reshape to (1,Z,X,Y,C)
-
-                    # Predict softmax probability (batch of 1)
-                    pred = model.predict(patch, verbose=0)
-                    pred = pred[0] # pred shape: (1,Z,X,Y,C) -> (Z,X,Y,C)
+            # Remove padding. Preview_pred shape now (X, Y)
+            preview_pred = preview_pred[px:px+nx, py:py+ny]
+            
+            # Also read the corresponding input slice
+            orig_slice = img[z_mid_slice, :, :].compute()
+            orig_slice = orig_slice[px:px+nx, py:py+ny] # Remove padding
+            plot_preview(orig_slice, preview_pred, z_mid_slice, out_store)
+        
+        # Planes before the next slab can receive no further contributions - normalise and write them once
+        if zi < row_stop-1:
+            accumulator.flush(z0 + stride[0] + core_margin)
+        else:
+            accumulator.flush()
+    
+    # Pipelined mode: reader threads prefetch batches and a writer thread applies results to the accumulator,
+    # so that reading and writing overlap with model inference. Otherwise each stage runs in turn.
+    if pipeline:
+        reader = prefetch(batches, read_batch, n_readers=n_readers, queue_depth=queue_depth)
+        writer = BackgroundWriter(queue_depth=queue_depth)
+        write = writer.submit
+    else:
+        reader = ((task, read_batch(*task)) for task in batches)
+        writer = contextlib.nullcontext()
+        write = lambda func, *args: func(*args)
 
-                    # Add weighted prediciton and weighs to accumlators in correct positions                    
-                    sum_arr[z0:z1, x0:x1, y0:y1, :] += pred * w_patch
-                    wsum_arr[z0:z1, x0:x1, y0:y1, :] += w_patch
-                    
-                    # Update progress bar
-                    step_i += 1
-                    pbar.update(1)
-       
-            if preview and z0>0 and z1<img.shape[0]: # Produce preview if flag present AND this is not the first/last slab (avoids printing padded region) 
-                # Normalize current accum/weights to preview
-                z_mid_slice = z0 + (volume_dims[0] // 2)
-                # Read single slice
-                preview_sum = sum_arr[z_mid_slice, :, :, :].astype(np.float32)
-                preview_w = wsum_arr[z_mid_slice, :, :, :].astype(np.float32)
-                
-                # Normalise to accumulated weights, avoid division by zero. preview_pred shape is (X Y C).
-                preview_pred = np.where(preview_w > 0, preview_sum/ np.maximum(preview_w, 1e-8), 0.0)
-                
-                # If n_classes>2 reverse OHE. otherwise print softmax output for foreground class
-                if n_classes >2:
-                    preview_pred = np.argmax(preview_pred, axis=-1)
+    # Inference step - iterate through windows in batches and blend with weighted sum.
+    # Softmax, labels and TIFF pages are written as each slab is finished.
+    n_predicted, n_skipped, model_time = 0, 0, 0.0
+    n_screened, screening_time = 0, 0.0
+    first_batch_time, n_timed = None, 0
+    tiff_context = contextlib.ExitStack()
+    if stream_tiff:
+        tiff_context.enter_context(tiff_file)
+        tiff_context.enter_context(tiff_writer)
+    with tiff_context, tqdm(total=total_patches, desc="Inference", unit="patch") as pbar, writer:
+        for i, ((zi, batch_coords, skipped_coords), batch) in enumerate(reader):
+            n_windows = len(batch_coords)+len(skipped_coords)
+            # Background windows are not passed to the model
+            if skipped_coords:
+                write(write_background, zi, skipped_coords)
+                n_skipped += len(skipped_coords)
+            
+            # Windows scored as empty by the screening network are filled with background instead of predicted
+            if batch_coords and screener is not None:
+                t0 = time.perf_counter()
+                keep = predict_batch(screener, batch)[:, 1] >= screening_threshold
+                screening_time += time.perf_counter()-t0
+                screened_coords = [coords for coords, k in zip(batch_coords, keep) if not k]
+                if screened_coords:
+                    write(write_background, zi, screened_coords)
+                    n_screened += len(screened_coords)
+                batch_coords = [coords for coords, k in zip(batch_coords, keep) if k]
+                batch = batch[keep]
+            
+            if batch_coords:
+                # Predict softmax probability for the whole batch in one call
+                t0 = time.perf_counter()
+                preds = predict_batch(model, batch) # preds shape: (N,Z,X,Y,C)
+                if first_batch_time is None:
+                    first_batch_time = time.perf_counter()-t0 # Includes any tracing/compilation
                 else:
-                    preview_pred = preview_pred[...,1]
-                    
-                # Remove padding. Preview_pred shape now (X, Y)
-                preview_pred = preview_pred[pad_widths[1][0]:img.shape[1]-pad_widths[1][1],
-                                  pad_widths[2][0]:img.shape[2]-pad_widths[2][1]]
-                
-                # Also read the corresponding input slice
-                orig_slice = img[z_mid_slice, :, :].compute()
-                orig_slice = orig_slice[pad_widths[1][0]:img.shape[1]-pad_widths[1][1],
-                                  pad_widths[2][0]:img.shape[2]-pad_widths[2][1]] # Remove padding
-                plot_preview(orig_slice, preview_pred, z_mid_slice, out_store)
-                
+                    model_time += time.perf_counter()-t0
+                    n_timed += len(batch_coords)
+                n_predicted += len(batch_coords)
+                write(write_batch, zi, batch_coords, preds)
+            
+            # Once the last batch in a slab is written, preview and flush the slab
+            if i == len(batches)-1 or batches[i+1][0] != zi:
+                write(finish_slab, zi)
+            
+            # Update progress bar
+            pbar.update(n_windows)
+            if progress is not None:
+                progress(pbar.n, total_patches)
+    
+    # Steady-state throughput excludes the first batch, which may include tracing/compilation
+    if n_timed > 0:
+        print("First batch took {:.2f} s. Steady-state inference: {:.2f} patches/s".format(
+            first_batch_time, n_timed/model_time))
+    
+    if background_threshold is not None:
+        time_saved = n_skipped*model_time/max(n_timed, 1)
+        print("Skipped {} of {} patches as background ({:.1f}%), saving approx. {:.1f} s of inference".format(
+            n_skipped, total_patches, 100*n_skipped/max(total_patches, 1), time_saved))
+    
+    if screener is not None:
+        time_saved = n_screened*model_time/max(n_timed, 1) - screening_time
+        print("Screening network skipped {} of {} patches ({:.1f}%) and took {:.1f} s, saving approx. {:.1f} s of inference".format(
+            n_screened, total_patches, 100*n_screened/max(total_patches, 1), screening_time, time_saved))
                 
-    # Crop outputs
-    sum_arr = sum_arr[pad_widths[0][0]:img.shape[0]-pad_widths[0][1],
-                      pad_widths[1][0]:img.shape[1]-pad_widths[1][1],
-                      pad_widths[2][0]:img.shape[2]-pad_widths[2][1]]
-    wsum_arr = wsum_arr[pad_widths[0][0]:img.shape[0]-pad_widths[0][1],
-                      pad_widths[1][0]:img.shape[1]-pad_widths[1][1],
-                      pad_widths[2][0]:img.shape[2]-pad_widths[2][1]]
-
-    # Normalize and write final zarr
-    # Create output store
-    labels = root.create_dataset("labels", shape=(Z, X, Y), chunks=volume_dims, dtype="uint8")
-    softmax = root.create_dataset("softmax", shape=(Z, X, Y, n_classes), chunks=(*volume_dims, n_classes), dtype="float32")
-    
-    # Process chunk-by-chunk to avoid OOM
-    for zi in tqdm(range(windows.shape[0]), desc="Normalising and saving"):
-        z0 = zi * stride[0]
-        z1 = z0 + volume_dims[0]
-        
-        # load a slab of weighted sums and weights
-        slab_sum = sum_arr[z0:z1, :, :, :]        # (vz,X,Y,C)
-        slab_w   = wsum_arr[z0:z1, :, :, 0:1]     # (vz,X,Y,1)
-        slab_sum = np.array(slab_sum)             # bring to RAM slab only
-        slab_w   = np.array(slab_w)
-        probs = np.where(slab_w > 0, slab_sum / np.maximum(slab_w, 1e-8), 0.0)  # (vz,X,Y,C)
-        
-        softmax[z0:z1, :, :, :]  =  probs      
-        labels[z0:z1, :, :] = np.argmax(probs, axis=-1).astype(np.uint8) 
+    # Optional: export BigTIFF 3D from labels if it could not be written during inference
+    if export_bigtiff and not stream_tiff:
+        export_labels_bigtiff(labels, export_bigtiff)
+
+    # Mark store as complete (checked when merging shards)
+    root.attrs["complete"] = True
+    ledger.update(complete=True)
 
-    # Delete sum_arr and wsum_arr now that we're finished with them
-    del root["sum"]
-    del root["wsum"]
+    return softmax if save_softmax else labels, os.path.join(out_store, "segmentation")
+
+def estimate_inference_memory(inference_dims, image_shape=None, n_classes=2, batch_size=1, queue_depth=4,
+                              bytes_per_voxel=512, model_overhead=1.5e9):
+    """
+    Rough estimate (bytes) of the peak RAM used by predict_segmentation_dask with a given inference window.
+    Counts model activations (bytes_per_voxel of each window in a batch - approx. 450-500 bytes were measured
+    for tUbeNet on CPU), queued input batches, and the accumulator and output buffers for one slab of the 
+    image (if image_shape is given), plus a fixed overhead for tensorflow and the model weights.
+    """
+    window_voxels = float(np.prod(inference_dims))
+    memory = model_overhead
+    memory += batch_size*window_voxels*bytes_per_voxel            # activations
+    memory += (queue_depth+1)*batch_size*window_voxels*4          # float32 input batches in flight
+    if image_shape is not None:
+        # Rolling accumulator plus normalised planes waiting to be written (each up to one window deep)
+        slab_voxels = float(inference_dims[0])*(image_shape[1]+inference_dims[1])*(image_shape[2]+inference_dims[2])
+        memory += 2*slab_voxels*n_classes*4
+    return memory
+
+def plan_inference_window(memory_budget, image_shape=None, n_classes=2, batch_size=1, queue_depth=4, 
+                          overlap_fraction=INFERENCE_OVERLAP_FRACTION, min_dims=(64, 64, 64), multiple=32, **kwargs):
+    """
+    Picks the largest inference window that fits in memory_budget (bytes), see estimate_inference_memory.
+    As tUbeNet is fully convolutional, it can be run on larger windows than used in training, which reduces 
+    the compute wasted on overlapping windows. Window sizes are multiples of 'multiple' (tUbeNet downsamples 
+    5 times, so 32), are at least min_dims, and are not larger than needed to cover the image. 
+    The overlap on each axis is overlap_fraction of the window.
+    Returns inference_dims, overlap
+    """
+    def round_up(n):
+        return int(-(-int(n)//multiple)*multiple)
+    
+    min_dims = [round_up(d) for d in min_dims]
+    max_dims = [round_up(d) for d in image_shape] if image_shape is not None else [None]*3
+    dims = list(min_dims)
+    while True:
+        # Grow every axis that can still grow by one step
+        candidate = [d+multiple if (m is None or d < m) else d for d, m in zip(dims, max_dims)]
+        if candidate == dims or estimate_inference_memory(candidate, image_shape=image_shape, n_classes=n_classes, 
+                                                          batch_size=batch_size, queue_depth=queue_depth, 
+                                                          **kwargs) > memory_budget:
+            break
+        dims = candidate
+    
+    if estimate_inference_memory(dims, image_shape=image_shape, n_classes=n_classes, batch_size=batch_size, 
+                                 queue_depth=queue_depth, **kwargs) > memory_budget:
+        print("Warning: even the minimum inference window {} may not fit in the memory budget".format(tuple(dims)))
+    overlap = tuple(int(round(d*overlap_fraction)) for d in dims)
+    return tuple(dims), overlap
 
-    # Optional: export BigTIFF 3D, slice-by-slice to handle very large images
+def plan_inference_shards(image_path, out_store, n_shards=2, volume_dims=(64, 64, 64), overlap=(16, 16, 16),
+                          n_classes=2, manifest_path=None, intensity_range=None, intensity_percentiles=(0, 100)):
+    """
+    Splits inference on a large image into shards of planes in the z axis, so that independent worker 
+    processes (on one machine or on several nodes sharing a filesystem) can each run predict_segmentation_dask
+    on one shard (see run_inference_shard). Shard boundaries are aligned to the output chunks, and each 
+    worker reads the halo of windows it needs to blend its planes, so merged results are identical to 
+    single-process inference.
+    The plan is written to a JSON manifest (default: out_store + "_manifest.json"). If a manifest with the
+    same settings already exists it is reused, so every worker in a job array can call this safely.
+    For TIFF images, the intensity range used for rescaling (see open_image) is found once (at the given
+    intensity_percentiles) and recorded in the manifest, so that all shards are rescaled identically.
+    Returns the path to the manifest.
+    """
+    if manifest_path is None:
+        manifest_path = str(out_store).rstrip("/\\")+"_manifest.json"
+    
+    existing = None
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            existing = json.load(f)
+    
+    # Shape only - rescaling is not needed here
+    Z = int(open_image(image_path, intensity_range=(0, 1)).shape[0])
+    
+    # Split planes into shards containing a whole number of output chunks
+    n_chunks = -(-Z//volume_dims[0])
+    n_shards = max(1, min(int(n_shards), n_chunks))
+    bounds = [int(round(i*n_chunks/n_shards))*volume_dims[0] for i in range(n_shards+1)]
+    bounds[-1] = Z
+    
+    manifest = {"image_path": str(image_path),
+                "out_store": str(out_store),
+                "volume_dims": [int(v) for v in volume_dims],
+                "overlap": [int(o) for o in overlap],
+                "n_classes": int(n_classes),
+                "shards": [{"id": i, 
+                            "z_range": [bounds[i], bounds[i+1]],
+                            "store": str(out_store).rstrip("/\\")+"_shard"+str(i)} for i in range(n_shards)],
+                "intensity_range": None if intensity_range is None else [float(v) for v in intensity_range],
+                "intensity_percentiles": [float(p) for p in intensity_percentiles]}
+    
+    # TIFF images are rescaled on the fly - find the intensity range once for all shards (reusing the existing plan's)
+    if str(image_path).lower().endswith(('.tif', '.tiff')) and manifest["intensity_range"] is None:
+        if existing is not None and existing.get("intensity_range") is not None and \
+           {**existing, "intensity_range": None} == manifest:
+            manifest["intensity_range"] = existing["intensity_range"]
+        else:
+            manifest["intensity_range"] = [float(v) for v in image_intensity_range(image_path, intensity_percentiles)]
+    
+    if existing is not None:
+        if existing == manifest:
+            return manifest_path
+        print("Replacing existing inference manifest at {}".format(manifest_path))
+    
+    # Write to temporary file then rename, so other workers never read a partial manifest
+    tmp_path = manifest_path+".tmp"+str(os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    print("Planned {} inference shards, manifest saved to {}".format(n_shards, manifest_path))
+    
+    return manifest_path
+
+def run_inference_shard(model, manifest_path, shard_id, **kwargs):
+    """Runs predict_segmentation_dask on one shard listed in an inference manifest (see plan_inference_shards).
+    Additional keyword arguments (e.g. batch_size, pipeline) are passed to predict_segmentation_dask."""
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    shard = manifest["shards"][int(shard_id)]
+    print("Running inference shard {} of {} (planes {}:{})".format(shard["id"]+1, len(manifest["shards"]), *shard["z_range"]))
+    kwargs["intensity_range"] = manifest.get("intensity_range") # Shared by all shards
+    
+    return predict_segmentation_dask(
+        model,
+        manifest["image_path"],
+        shard["store"],
+        volume_dims=tuple(manifest["volume_dims"]),
+        overlap=tuple(manifest["overlap"]),
+        n_classes=manifest["n_classes"],
+        z_range=shard["z_range"],
+        **kwargs)
+
+def merge_inference_shards(manifest_path, export_bigtiff=None, cleanup=True):
+    """
+    Stitches the 'labels' and 'softmax' arrays of each finished shard (see plan_inference_shards) into a 
+    single output store at the out_store path given in the manifest. Shards must all be complete. 
+    Optionally exports a BigTIFF and deletes the shard stores (and their ledgers) once merged.
+    """
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    
+    # Check all shards have finished before merging
+    shard_roots = []
+    for shard in manifest["shards"]:
+        shard_root = zarr.open(shard["store"], mode="r") if os.path.exists(shard["store"]) else None
+        if shard_root is None or not shard_root.attrs.get("complete", False):
+            raise RuntimeError("Inference shard {} ({}) has not finished".format(shard["id"], shard["store"]))
+        shard_roots.append(shard_root)
+    
+    volume_dims = manifest["volume_dims"]
+    n_classes = manifest["n_classes"]
+    Z = manifest["shards"][-1]["z_range"][1]
+    X, Y = shard_roots[0]["labels"].shape[1:]
+    
+    # Output arrays match the type and compression used by the shards
+    save_softmax = "softmax" in shard_roots[0]
+    root = zarr.open(manifest["out_store"], mode="w")
+    labels, softmax = create_prediction_arrays(root, (Z, X, Y), volume_dims=volume_dims, n_classes=n_classes,
+                                               softmax_dtype=str(shard_roots[0]["softmax"].dtype) if save_softmax else 'float32',
+                                               save_softmax=save_softmax,
+                                               compressors=shard_roots[0]["labels"].compressors)
+    
+    # Copy each shard one slab at a time
+    for shard, shard_root in zip(manifest["shards"], shard_roots):
+        z_start, z_stop = shard["z_range"]
+        for z0 in tqdm(range(z_start, z_stop, volume_dims[0]), desc="Merging shard "+str(shard["id"])):
+            z1 = min(z0 + volume_dims[0], z_stop)
+            labels[z0:z1] = shard_root["labels"][z0-z_start:z1-z_start]
+            if save_softmax:
+                softmax[z0:z1] = shard_root["softmax"][z0-z_start:z1-z_start]
+    root.attrs["z_range"] = [0, Z]
+    root.attrs["complete"] = True
+    
+    # Optional: export BigTIFF 3D
     if export_bigtiff:
-        with tiff.TiffWriter(export_bigtiff, bigtiff=True) as tw:
-            for z in tqdm(range(Z), desc="Export BigTIFF", unit="slice"):
-                seg_slice = np.array(labels[z, :, :])  # bring one 2D slice to RAM
-                tw.write(seg_slice, photometric="minisblack", metadata=None)
+        export_labels_bigtiff(labels, export_bigtiff)
+    
+    if cleanup:
+        for shard in manifest["shards"]:
+            shutil.rmtree(shard["store"], ignore_errors=True)
+            ledger = str(shard["store"]).rstrip("/\\")+"_ledger.json" # Written by predict_segmentation_dask
+            if os.path.isfile(ledger):
+                os.remove(ledger)
+    
+    return softmax if save_softmax else labels, manifest["out_store"]
 
-    return softmax, os.path.join(out_store, "segmentation")
+def chunk_hashes(img):
+    """Content hash (64 bit) of every chunk of a dask array, returned as an array with one entry per chunk.
+    Reads the whole array once."""
+    def block_hash(block):
+        digest = hashlib.blake2b(np.ascontiguousarray(block).tobytes(), digest_size=8).digest()
+        return np.full((1,)*block.ndim, int.from_bytes(digest, 'little'), dtype=np.uint64)
+    return img.map_blocks(block_hash, chunks=(1,)*img.ndim, dtype=np.uint64).compute()
+
+def model_hash(model):
+    """Hash (hex string) identifying the weights of a model: a keras model, a TFLiteModel (file contents), or a 
+    wrapper holding one as .model (a compiled tUbeNet.inference_function or a BatchingPredictor). 
+    Returns None if the model cannot be identified."""
+    while not isinstance(model, tf.keras.Model) and hasattr(model, 'model'):
+        model = model.model
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(model, tf.keras.Model):
+        for w in model.get_weights():
+            h.update(np.ascontiguousarray(w).tobytes())
+    elif hasattr(model, 'filename') and os.path.isfile(str(model.filename)):
+        with open(model.filename, 'rb') as f:
+            h.update(f.read())
+    else:
+        return None
+    return h.hexdigest()
+
+def changed_region(changed, chunks, image_shape, volume_dims=(64, 64, 64), stride=(32, 32, 32), pad_widths=None):
+    """
+    Voxels whose predictions depend on modified chunks of the image.
+    changed = boolean array with one entry per chunk of the image (True if the chunk was modified)
+    chunks = chunk sizes along each axis (dask chunks of the image)
+    Windows reading any changed chunk (including reflected padding at the image edges) must be predicted again,
+    and every voxel they cover must be blended again. Returns these voxels as a lazy boolean dask array with the 
+    same chunks as the image, and the number of windows reading changed chunks.
+    """
+    def box_query(grid):
+        # Whether grid has any True element in boxes of indices lo[a]:hi[a]+1 along each axis (summed-area table)
+        table = np.zeros(tuple(n+1 for n in grid.shape), dtype=np.int64)
+        table[1:, 1:, 1:] = grid.astype(np.int64).cumsum(0).cumsum(1).cumsum(2)
+        def query(lo, hi):
+            total = 0
+            for corner in itertools.product((0, 1), repeat=3):
+                index = np.ix_(*[hi[a]+1 if c else lo[a] for a, c in enumerate(corner)])
+                total = total + (-1)**(3-sum(corner)) * table[index]
+            return total > 0
+        return query
+    
+    pads = [int(p[0]) for p in pad_widths]
+    n_windows, chunk_lo, chunk_hi = [], [], []
+    for ax in range(3):
+        length, v, s = int(image_shape[ax]), int(volume_dims[ax]), int(stride[ax])
+        n = (length + sum(pad_widths[ax]) - v)//s + 1
+        # Range of the image read by each window along this axis, including reflected padding
+        starts = np.arange(n)*s - pads[ax]
+        ends = starts + v
+        a, b = np.maximum(starts, 0), np.minimum(ends, length)
+        b = np.where(starts < 0, np.maximum(b, np.minimum(1-starts, length)), b)
+        a = np.where(ends > length, np.minimum(a, np.maximum(2*length-1-ends, 0)), a)
+        a = np.minimum(a, length-1)
+        b = np.maximum(b, a+1)
+        bounds = np.cumsum((0,)+tuple(chunks[ax]))
+        n_windows.append(n)
+        chunk_lo.append(np.searchsorted(bounds, a, 'right')-1)
+        chunk_hi.append(np.searchsorted(bounds, b-1, 'right')-1)
+    affected = box_query(np.asarray(changed, dtype=bool))(chunk_lo, chunk_hi) # (nz, nx, ny) windows to predict again
+    covered = box_query(affected)
+    
+    def block_mask(block, block_info=None):
+        # Voxels in this block covered by an affected window
+        lo, hi = [], []
+        for ax, (t0, t1) in enumerate(block_info[0]['array-location']):
+            t = np.arange(t0, t1) + pads[ax] # padded coordinates
+            v, s = int(volume_dims[ax]), int(stride[ax])
+            lo.append(np.clip(-(-(t-v+1)//s), 0, n_windows[ax]-1))
+            hi.append(np.clip(t//s, 0, n_windows[ax]-1))
+        return covered(lo, hi)
+    
+    mask = da.zeros(tuple(image_shape), chunks=chunks, dtype=bool).map_blocks(block_mask, dtype=bool)
+    return mask, int(affected.sum())
+
+def update_segmentation_dask(model, image_path, out_store, volume_dims=(64, 64, 64), overlap=(16, 16, 16), n_classes=2, 
+                             export_bigtiff=None, intensity_range=None, **kwargs):
+    """
+    Incremental re-inference. Runs predict_segmentation_dask on the whole image, and records a content hash of 
+    every chunk of the image and a hash of the model weights (see chunk_hashes and model_hash) in out_store.
+    When run again on an existing output, only windows reading chunks of the image that have changed since 
+    (plus the windows overlapping them, needed for blending) are predicted again, and 'labels' and 'softmax' 
+    are patched in place. Everything is predicted again if the model or inference settings have changed, 
+    or the model cannot be identified.
+    Additional keyword arguments (e.g. batch_size, stitching) are passed to predict_segmentation_dask.
+    Returns the number of windows reading changed chunks (None if everything was predicted).
+    """
+    if kwargs.get('roi') is not None or kwargs.get('z_range') is not None:
+        raise ValueError("Incremental inference applies to the whole image - roi and z_range cannot be used")
+    # Find the intensity range of TIFFs once, rather than in each call below
+    if intensity_range is None and str(image_path).lower().endswith(('.tif', '.tiff')):
+        intensity_range = image_intensity_range(image_path, kwargs.get('intensity_percentiles', (0, 100)))
+    img = open_image(image_path, intensity_range=intensity_range)
+    if img.ndim == 4 and img.shape[-1] == 1:
+        img = img[..., 0]
+    
+    # Settings affecting predictions (run options such as batch size or threads are not compared)
+    run_options = ('batch_size', 'pipeline', 'n_readers', 'queue_depth', 'preview', 'resume', 'progress', 'screener')
+    settings = {"image_shape": [int(n) for n in img.shape],
+                "chunks": [[int(c) for c in ax] for ax in img.chunks],
+                "volume_dims": [int(v) for v in volume_dims],
+                "overlap": [int(o) for o in overlap],
+                "n_classes": int(n_classes),
+                "intensity_range": [float(i) for i in intensity_range] if intensity_range is not None else None,
+                "model": model_hash(model),
+                "screener": model_hash(kwargs['screener']) if kwargs.get('screener') is not None else None}
+    settings.update({k: v for k, v in kwargs.items() if k not in run_options})
+    settings = json.loads(json.dumps(settings)) # As stored in zarr attributes (tuples become lists)
+    
+    print("Hashing image chunks of {}".format(image_path))
+    hashes = chunk_hashes(img)
+    
+    # Compare with the record of the previous run
+    previous = None
+    if os.path.exists(out_store):
+        root = zarr.open(out_store, mode="r")
+        if root.attrs.get("complete") and "input_hashes" in root:
+            previous = root.attrs.get("incremental")
+    if previous is None or previous != settings or settings["model"] is None:
+        reason = ("no previous output" if previous is None else 
+                  "model cannot be identified" if settings["model"] is None else "model or settings changed")
+        print("Predicting whole image ({})".format(reason))
+        predict_segmentation_dask(model, image_path, out_store, volume_dims=volume_dims, overlap=overlap, 
+                                  n_classes=n_classes, export_bigtiff=export_bigtiff, intensity_range=intensity_range, 
+                                  **kwargs)
+        n_updated = None
+    else:
+        changed = hashes != root["input_hashes"][:]
+        if not changed.any():
+            print("No image chunks have changed - {} is up to date".format(out_store))
+            return 0
+        stride = np.array(volume_dims, dtype="int32")-np.array(overlap, dtype="int32")
+        _, pad_widths = auto_pad(img, volume_dims, stride)
+        mask, n_updated = changed_region(changed, img.chunks, img.shape, volume_dims, stride, pad_widths)
+        print("{} of {} image chunks changed - predicting the {} windows reading them (and windows overlapping these) again".format(
+            changed.sum(), changed.size, n_updated))
+        predict_segmentation_dask(model, image_path, out_store, volume_dims=volume_dims, overlap=overlap, 
+                                  n_classes=n_classes, intensity_range=intensity_range, 
+                                  roi=mask, roi_output='patch', **kwargs)
+        if export_bigtiff:
+            export_labels_bigtiff(zarr.open(out_store, mode="r")["labels"], export_bigtiff)
+    
+    # Record image chunk hashes and settings for the next run
+    root = zarr.open(out_store, mode="r+")
+    root.create_dataset("input_hashes", shape=hashes.shape, chunks=hashes.shape, dtype=hashes.dtype, overwrite=True)[...] = hashes
+    root.attrs["incremental"] = settings
+    return n_updated
+
+def calibration_patches(data_dir, volume_dims=(64, 64, 64), n_patches=100, seed=0):
+    """Yields n_patches randomly placed image windows (1,Z,X,Y,1) drawn from the images listed in data_dir, 
+    e.g. to calibrate int8 quantisation (see tUbeNet.export_tflite). Labels are not required."""
+    rng = np.random.default_rng(seed)
+    images = [open_image(p) for p in data_dir.image_filenames]
+    for i in range(n_patches):
+        img = images[i % len(images)]
+        z0, x0, y0 = [int(rng.integers(0, max(1, img.shape[ax]-volume_dims[ax]+1))) for ax in range(3)]
+        patch = np.zeros(volume_dims, dtype=np.float32) # zero padded if the image is smaller than volume_dims
+        window = np.asarray(img[z0:z0+volume_dims[0], x0:x0+volume_dims[1], y0:y0+volume_dims[2]])
+        patch[:window.shape[0], :window.shape[1], :window.shape[2]] = window
+        yield patch[None, ..., None]
+
+def tflite_op_summary(filename):
+    """Counts the ops of a TFLite model that compute in int8 and in float (by the type of their output), e.g. to
+    check how much of an int8 export actually runs in int8. Quantise/dequantise ops and integer shape 
+    arithmetic are not counted. Returns a dict of {'int8': {op name: count}, 'float': {op name: count}}."""
+    interpreter = tf.lite.Interpreter(model_path=filename, 
+                                      experimental_op_resolver_type=tf.lite.experimental.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES)
+    tensors = {t['index']: t['dtype'] for t in interpreter.get_tensor_details()}
+    summary = {'int8': {}, 'float': {}}
+    for op in interpreter._get_ops_details():
+        if op['op_name'] in ('QUANTIZE', 'DEQUANTIZE') or len(op['outputs']) == 0:
+            continue
+        dtype = tensors[op['outputs'][0]]
+        kind = 'int8' if dtype in (np.int8, np.uint8) else 'float' if np.issubdtype(dtype, np.floating) else None
+        if kind is not None:
+            summary[kind][op['op_name']] = summary[kind].get(op['op_name'], 0)+1
+    return summary
+
+def compare_models(reference_model, model, image_path, output_path, volume_dims=(64, 64, 64), 
+                   overlap=(16, 16, 16), n_classes=2, batch_size=1, z_range=None):
+    """
+    Runs predict_segmentation_dask on a reference image with two models (e.g. a float model and a quantised 
+    TFLite model) and reports the Dice score of the second model's labels against the first for each 
+    foreground class, and the speedup in inference time. Predictions are saved in output_path.
+    Returns a dictionary of Dice scores, inference times and speedup.
+    """
+    times, label_paths = [], []
+    for name, m in (("reference", reference_model), ("comparison", model)):
+        out_store = os.path.join(output_path, name+"_prediction")
+        t0 = time.perf_counter()
+        predict_segmentation_dask(m, image_path, out_store, volume_dims=volume_dims, overlap=overlap, 
+                                  n_classes=n_classes, batch_size=batch_size, z_range=z_range, save_softmax=False)
+        times.append(time.perf_counter()-t0)
+        label_paths.append(os.path.join(out_store, "labels"))
+    
+    reference_labels, labels = da.from_zarr(label_paths[0]), da.from_zarr(label_paths[1])
+    dice = []
+    for c in range(1, n_classes):
+        intersection, total = da.compute(da.sum((reference_labels==c) & (labels==c)), 
+                                         da.sum(reference_labels==c) + da.sum(labels==c))
+        dice.append(float(2*intersection/total) if total > 0 else 1.0)
+        print("Dice against reference for class {}: {:.4f}".format(c, dice[-1]))
+    speedup = times[0]/times[1]
+    print("Inference time: reference {:.1f} s, comparison {:.1f} s (speedup x{:.2f})".format(times[0], times[1], speedup))
+    
+    return {"dice": dice, "reference_time": times[0], "time": times[1], "speedup": speedup}
+
+def screening_report(screener, generator, model=None, n_batches=20, thresholds=(0.02, 0.05, 0.1, 0.2, 0.3, 0.5)):
+    """
+    Estimates the recall lost and the inference time saved by a screening network (see tUbeNet.build_screener) 
+    at a range of screening thresholds, on labelled windows from generator (a DataGenerator - use vessel_threshold=-1, 
+    so that windows are drawn as they occur in the data rather than preferring windows containing vessels).
+    For each threshold, reports the fraction of windows skipped and the fraction of labelled vessel voxels in 
+    skipped windows (recall lost - an upper bound, as windows overlap during inference). If the full model is 
+    given, both networks are timed and the fraction of inference time saved (after the cost of screening) is reported.
+    Returns a list of dictionaries, one for each threshold.
+    """
+    scores, vessel_voxels = [], []
+    screener_time, model_time, n_timed = 0.0, 0.0, 0
+    for b in tqdm(range(n_batches), desc="Screening report"):
+        X, y = generator[b]
+        X = X.astype(np.float32)
+        t0 = time.perf_counter()
+        scores.append(predict_batch(screener, X)[:, 1])
+        t1 = time.perf_counter()
+        if model is not None:
+            predict_batch(model, X)
+        # First batch is not timed, as it may include tracing
+        if b > 0:
+            screener_time += t1-t0
+            model_time += time.perf_counter()-t1
+            n_timed += len(X)
+        vessel_voxels.append(y[..., 1:].sum(axis=(1, 2, 3, 4)))
+    scores, vessel_voxels = np.concatenate(scores), np.concatenate(vessel_voxels)
+    
+    print("Threshold | Windows skipped | Recall lost | Time saved")
+    report = []
+    for threshold in thresholds:
+        skipped = scores < threshold
+        result = {"threshold": threshold,
+                  "skipped": float(skipped.mean()),
+                  "recall_lost": float(vessel_voxels[skipped].sum()/max(vessel_voxels.sum(), 1)),
+                  "time_saved": None}
+        if model is not None and n_timed > 0:
+            result["time_saved"] = float(result["skipped"] - screener_time/max(model_time, 1e-8))
+        report.append(result)
+        print("{:9.3f} | {:14.1f}% | {:10.2f}% | {}".format(
+            threshold, 100*result["skipped"], 100*result["recall_lost"], 
+            "{:.1f}%".format(100*result["time_saved"]) if result["time_saved"] is not None else "-"))
+    return report
 
 #-----------------------PREPROCESSING FUNCTIONS--------------------------------------------------------------------------------------------------------------
+def open_volume(path, chunks='auto', channels=False):
+    """Opens an image or label volume for preprocessing as a lazy dask array, without loading it into memory.
+    TIFF/OME-TIFF stacks are read with TiffVolume (memory-mapped if uncompressed), NIfTI files (.nii/.nii.gz) 
+    through the nibabel array proxy, zarr arrays as they are, and directories of 2D slices one slice at a time 
+    (in alphabetical order). Other formats are read whole with skimage.io.imread.
+    chunks = chunk size the volume will be saved with. Files are read in slabs of chunks[0] planes, so 
+            rechunking holds about one row of chunks in memory per thread
+    channels = if True, multi-channel TIFFs are returned as (Z,X,Y,C). Otherwise only the first channel is read"""
+    path = str(path)
+    slab = chunks[0] if isinstance(chunks, (tuple, list)) else 'auto'
+    if os.path.isdir(path) and not path.rstrip('/\\').endswith('.zarr'):
+        # Directory of 2D slices: one task per slice
+        import dask
+        files = [os.path.join(path, f) for f in sorted(os.listdir(path)) if os.path.isfile(os.path.join(path, f))]
+        if not files:
+            raise ValueError("No image slices found in {}".format(path))
+        read = tiff.imread if files[0].lower().endswith(('.tif', '.tiff')) else io.imread
+        first = read(files[0])
+        slices = [da.from_delayed(dask.delayed(read)(f), shape=first.shape, dtype=first.dtype) for f in files]
+        return da.stack(slices)
+    elif path.rstrip('/\\').endswith('.zarr'):
+        return da.from_zarr(path)
+    elif path.lower().endswith(('.tif', '.tiff')):
+        from tUbeNet_classes import TiffVolume
+        # Pages are read once each, in order, so are not cached
+        volumes = [TiffVolume(path, cache_planes=0)]
+        if channels:
+            volumes += [TiffVolume(path, channel=c, cache_planes=0) for c in range(1, volumes[0].n_channels)]
+        slabs = [da.from_array(v, chunks=(slab, -1, -1), asarray=False) for v in volumes]
+        return slabs[0] if len(slabs) == 1 else da.stack(slabs, axis=-1)
+    elif path.lower().endswith(('.nii', '.nii.gz')):
+        import nibabel as nib
+        # NIfTI data is stored (X,Y,Z) with X varying fastest: read whole Z planes, and transpose to the 
+        # (Z,Y,X) ordering used when these files are read with skimage (SimpleITK)
+        proxy = nib.load(path).dataobj
+        return da.from_array(proxy, chunks=(-1, -1, 1)+(-1,)*(proxy.ndim-3), asarray=False).transpose(
+            (2, 1, 0)+tuple(range(3, proxy.ndim)))
+    return da.from_array(io.imread(path), chunks=chunks)
+
+def remap_labels(block, values, classes):
+    """Replaces each label value in a block with its class, from a lookup table of values (sorted) and classes.
+    Values not in the table become class 0."""
+    index = np.clip(np.searchsorted(values, block), 0, len(values)-1)
+    return np.where(values[index] == block, classes[index], 0).astype(classes.dtype)
+
+def merge_label_channels(block, values, classes):
+    """Merges the channels (last axis) of a block of multi-channel labels into a single class map (see 
+    fix_label_format), using a lookup table (values, classes) for each channel. Where labels overlap, 
+    later channels overwrite earlier ones.
+    Returns the class map and the number of voxels of each class that overwrote another class."""
+    merged = np.zeros(block.shape[:-1], dtype=np.int16)
+    overwritten = np.zeros(max(c.max() for c in classes)+1, dtype=np.int64)
+    for c in range(block.shape[-1]):
+        labels = remap_labels(block[..., c], values[c], classes[c])
+        overwritten += np.bincount(labels[(labels != 0) & (merged != 0)], minlength=len(overwritten))
+        merged = np.where(labels != 0, labels, merged)
+    return merged, overwritten
+
 def fix_label_format(seg, chunks):
     """ Finds unique classes in mutli-channel segmentation files, 
     and combines into a single 3D array, where each class has a unique pixel value.
     E.g. (Z,X,Y,2) where thefirst channel has pixel values 0 and 1, and the second channel has 
-    pixel values 0, 1, 2 becomes (Z,X,Y) with pixel values 0, 1, 2, 3"""
+    pixel values 0, 1, 2 becomes (Z,X,Y) with pixel values 0, 1, 2, 3
+    Takes two passes through the labels however many classes there are: one to find the values in each channel,
+    and one to count overlapping labels. The merged labels are returned as a lazy dask array."""
     
     print("Merging channels into a single class map")
     assert len(seg.shape)==4, "Expected (Z, X, Y) or (Z, X, Y, C) segmentation"
     
-    seg = da.from_array(seg) # Create Dask Array with automatic chunk size
-    channel_info = {} # Record info about unique classes in each channel
-
-    for c in range(seg.shape[-1]):
-        values = da.unique(seg[..., c]).compute()
-        assert len(values)<51, "Over 50 unqiue classes identified - check labels file is correct."
-        channel_info[c] = values
-        print(f"Channel {c} classes: {values}")
-
-    merged = da.zeros(seg.shape[:-1], chunks=chunks, dtype="int16")
+    seg = da.asarray(seg) # Create Dask Array with automatic chunk size
+    seg = seg.rechunk({3: -1}) # All channels of a voxel in the same block
+    
+    # Values in every channel, found together in one pass
+    channel_values = da.compute(*[da.unique(seg[..., c]) for c in range(seg.shape[-1])])
+    
+    # Lookup table for each channel: nonzero values are given consecutive classes starting at 1
+    values, classes = [], []
     next_class = 1 #Start re-labelling classes starting at 1
+    for c, v in enumerate(channel_values):
+        assert len(v)<51, "Over 50 unqiue classes identified - check labels file is correct."
+        print(f"Channel {c} classes: {v}")
+        v = v[v != 0] # Skip background class in each channel
+        values.append(v)
+        classes.append(np.arange(next_class, next_class+len(v), dtype=np.int16))
+        next_class += len(v)
+    values = [v if len(v) else np.zeros(1, dtype=seg.dtype) for v in values] # Empty channels map to background
+    classes = [c if len(c) else np.zeros(1, dtype=np.int16) for c in classes]
     
-    for c, values in channel_info.items():
-        for v in values:
-            if v == 0: # Skip background class in each channel
-                continue
-
-            mask = seg[..., c] == v
-            # Check for overlapping classes
-            overlap = da.logical_and(mask, merged!=0)
-            if da.any(overlap).compute():
-                tot = da.sum(overlap).compute()
-                print(f"WARNING: Overlap detected for channel {c}, value {v} ({tot} pixels). Previous label overwritten.")
-
-            merged = da.where(mask, next_class, merged)
-            next_class += 1
+    # Count voxels of each class, and voxels overwriting another class (overlaps)
+    n = max(c.max() for c in classes)+1
+    def block_counts(block):
+        merged, overwritten = merge_label_channels(block, values, classes)
+        return np.concatenate([np.bincount(merged.ravel(), minlength=n), overwritten]).reshape(1, 1, 1, -1)
+    counts = seg.map_blocks(block_counts, chunks=(1, 1, 1, 2*n), dtype=np.int64).sum(axis=(0, 1, 2)).compute()
+    class_counts, overwritten = counts[:n], counts[n:]
+    for c in range(len(values)):
+        for v, new in zip(values[c], classes[c]):
+            if new != 0 and overwritten[new] > 0:
+                print(f"WARNING: Overlap detected for channel {c}, value {v} ({overwritten[new]} pixels). Previous label overwritten.")
     
-    print("Labels file now has shape "+str(merged.shape)+" with classes "+str(da.unique(merged).compute())+".")
+    merged = seg.map_blocks(lambda block: merge_label_channels(block, values, classes)[0], drop_axis=3, dtype=np.int16)
+    merged = merged.rechunk(chunks)
+    
+    print("Labels file now has shape "+str(merged.shape)+" with classes "+str(np.flatnonzero(class_counts))+".")
     
     return merged
 
-def data_preprocessing(image_path=None, label_path=None, chunks='auto'):
+def data_preprocessing(image_path=None, label_path=None, chunks='auto', percentiles=(0, 100), intensity_range=None):
     """# Pre-processing
     Load data, downsample if neccessary, normalise and pad.
     Inputs:
-    image_path = path to image data (string)
+    image_path = path to image data (string): TIFF, NIfTI, zarr or a directory of 2D slices (see open_volume)
     label_path = path to labels (string)
+    percentiles = percentiles of the image intensities rescaled to 0 and 1 (values outside are clipped)
+    intensity_range = (min, max) intensities rescaled to 0 and 1, e.g. from another dataset's header. 
+                      Found from an intensity histogram of the image if None
     Outputs:
-    img_pad = image data as an np.array, scaled between 0 and 1
-    seg_pad = label data as an np.array, scaled between 0 and 1
-    classes = list of classes present in labels
+    img_pad = image data as a lazy dask array, scaled between 0 and 1
+    seg_pad = label data as a lazy dask array, with classes as consecutive integers
+    intensity_range = (min, max) intensities used for rescaling
     """
     
-    # Load image
+    # Open image (read lazily, see open_volume)
     print('Loading images from '+str(image_path))
-    img=io.imread(image_path)
-    img=da.from_array(img,chunks=chunks)
+    img=open_volume(image_path, chunks)
     print('Size '+str(img.shape))
 
     if len(img.shape)==4:
@@ -300,10 +1392,14 @@ def data_preprocessing(image_path=None, label_path=None, chunks='auto'):
     assert img.ndim == 3, "Expected (Z,X,Y) image"
     
     # Normalise 
-    print('Rescaling data between 0 and 1')
-    img_min = da.min(img)
-    denominator = da.nanmax(img)-img_min 
-    img = (img-img_min)/denominator # Rescale between 0 and 1
+    # The intensity range is found in a separate pass through the image: if left in the same graph as the 
+    # saved array, every chunk read would be held in memory until the range was known
+    if intensity_range is None:
+        intensity_range = histogram_range(intensity_histogram(img), percentiles)
+    print('Rescaling data between 0 and 1 (intensity range {} to {})'.format(*intensity_range))
+    img_min, img_max = (np.float32(v) for v in intensity_range)
+    denominator = img_max-img_min 
+    img = da.clip((img.astype('float32')-img_min)/denominator, 0, 1) # Rescale between 0 and 1
     
     # Set data type
     img = img.astype('float32')
@@ -311,14 +1407,13 @@ def data_preprocessing(image_path=None, label_path=None, chunks='auto'):
 	#Repeat for labels is present
     if label_path is not None:
         print('Loading labels from '+str(label_path))
-        seg = io.imread(label_path)
+        seg = open_volume(label_path, chunks, channels=True)
         
         # Find the number of unique classes in segmented training set
         if len(seg.shape)>3:
             # Assume classes are saved as different channels
             seg = fix_label_format(seg, chunks)
         else:
-            seg = da.from_array(seg,chunks=chunks)
             classes = da.unique(seg).compute()
             
             assert len(classes)<51, "Over 50 unqiue classes identified - check labels file is correct."
@@ -329,30 +1424,27 @@ def data_preprocessing(image_path=None, label_path=None, chunks='auto'):
             is_consecutive = (classes[0] == 0 and np.array_equal(classes, np.arange(len(classes))))
     
             # If not - map classes to integer label values starting at 0
+            # (one blockwise pass through a lookup table, however many classes there are)
             if not is_consecutive:
-                mapping = {old: new for new, old in enumerate(classes)}
-                seg_mapped = da.zeros_like(seg, dtype=np.int32)
-                for old, new in mapping.items():
-                    seg_mapped[seg==old] = new
-                seg = seg_mapped
+                seg = seg.map_blocks(remap_labels, values=classes, classes=np.arange(len(classes), dtype=np.int16), 
+                                     dtype=np.int16)
             
             seg = seg.astype('int16')            
            		
-        return img, seg
+        return img, seg, intensity_range
 
-    return img, None
+    return img, None, intensity_range
 
 def list_image_files(directory):
     """ Lists files in a directory. 
     If given a path to a single file - splits the directory path from the filename.
     Returns directory path and list of filename."""
-    if os.path.isdir(directory):
-        # Add all file paths of image_paths
-        image_filenames = [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
-        image_filenames = sorted(image_filenames) # Sort alphabetically
-    elif os.path.isfile(directory):
+    if os.path.isdir(directory) and not directory.rstrip('/\\').endswith('.zarr'):
+        # Add all file paths of image_paths (subdirectories are read as stacks of 2D slices or zarr arrays)
+        image_filenames = sorted(os.listdir(directory)) # Sort alphabetically
+    elif os.path.exists(directory):
         # If file is given, process this file only
-        directory, image_filenames = os.path.split(directory.replace('\\','/'))
+        directory, image_filenames = os.path.split(directory.replace('\\','/').rstrip('/'))
         image_filenames = [image_filenames]
     else:
         return None, None
@@ -382,46 +1474,268 @@ def split_train_test(labels, data, val_fraction):
     
     return train_data, train_labels, test_data, test_labels
             
-def save_as_zarr_array(data, labels=None, output_path=None, output_name=None, chunks=(64,64,64)):
+def create_zarr_array(path, shape, dtype, chunks=(64,64,64), shards=None, compressor='default', compression_level=None, 
+                      overwrite=False):
+    """Creates a zarr array for preprocessed data.
+    chunks = shape of the chunks read and written as a unit (e.g. one training window)
+    shards = shape of the files chunks are stored in (zarr v3 sharding), a multiple of chunks. With 64^3 chunks,
+             a 4096^3 volume is stored in 262,144 files - shards of 256^3 reduce this to 4,096. 
+             None for one file per chunk
+    compressor, compression_level = codec for each chunk (see zarr_compressors)"""
+    chunks = tuple(int(c) for c in chunks)
+    if shards is not None:
+        shards = tuple(int(s) for s in shards)
+        if any(s % c for s, c in zip(shards, chunks)):
+            raise ValueError("Shards {} must be a multiple of chunks {}".format(shards, chunks))
+    return zarr.create_array(str(path), shape=tuple(int(n) for n in shape), dtype=dtype, chunks=chunks, shards=shards,
+                             compressors=zarr_compressors(compressor, compression_level), overwrite=overwrite)
+
+def write_zarr_array(data, path, dtype=None, chunks=(64,64,64), shards=None, compressor='default', compression_level=None,
+                     overwrite=False, compute=True):
+    """Saves a dask array in zarr format (see create_zarr_array for the layout options), optionally converting to dtype.
+    Each task writes whole shards, as shards written by several tasks at once could lose chunks.
+    If compute=False, returns a dask object that writes the data when computed (e.g. together with statistics of 
+    the data, in one pass) instead of the array."""
+    if dtype is not None:
+        data = data.astype(dtype)
+    array = create_zarr_array(path, data.shape, data.dtype, chunks=chunks, shards=shards, compressor=compressor, 
+                              compression_level=compression_level, overwrite=overwrite)
+    stored = da.store(data.rechunk(shards or chunks), array, lock=False, compute=compute)
+    return array if compute else stored
+
+def foreground_fractions(labels, block=(64,64,64)):
+    """Fraction of labelled (non-zero) voxels in each block of labels, as a float32 array with one value per 
+    block (blocks at the edges of labels may be smaller). Used by DataGenerator to sample training windows only 
+    from blocks containing vessels, instead of reading and rejecting windows of background."""
+    labels = da.asarray(labels).rechunk(block)
+    return labels.map_blocks(lambda b: np.full((1,1,1), np.count_nonzero(b)/max(b.size, 1), dtype=np.float32), 
+                             chunks=(1,1,1), dtype=np.float32)
+
+def save_as_zarr_array(data, labels=None, output_path=None, output_name=None, chunks=(64,64,64), intensity_range=None,
+                       shards=None, compressor='default', compression_level=None, label_chunks=None, label_shards=None, 
+                       label_dtype=None, label_compressor=None, label_compression_level=None):
     """"Data (and optionally labels) are saved in chunked zarr format.
-    A data header is created to record image shape, ID and path for data/labels."""
+    The dataset is added to the catalogue in output_path/headers (see update_catalogue), recording its ID, shape, 
+    paths for data/labels, layout, the intensity range used to rescale the data (see data_preprocessing), and the
+    mean and standard deviation of the rescaled data.
+    shards, compressor and compression_level set how chunks are stored (see create_zarr_array). Labels are 
+    stored in the same way unless label_chunks, label_shards, label_compressor or label_compression_level are 
+    given, and can be converted to label_dtype (e.g. 'uint8', for up to 255 classes).
+    A foreground index (see foreground_fractions) is saved alongside the labels, with one value per label chunk, 
+    and the number of voxels of each class is added to the catalogue."""
     # Create header folder if does not exist
     header_folder=os.path.join(output_path, "headers")
-    if not os.path.exists(header_folder):
-        os.makedirs(header_folder)
-    header_name=os.path.join(header_folder,str(output_name)+"_header")
+    os.makedirs(header_folder, exist_ok=True)
     
-    # Rechunk dask array and save as zarr
-    data = data.rechunk(chunks)
-    data.to_zarr(os.path.join(output_path, output_name))
-    
-    from tUbeNet_classes import DataHeader
+    # Rechunk dask array and save as zarr, computing intensity statistics in the same pass
+    image_filename = os.path.join(output_path, output_name)
+    stored = write_zarr_array(data, image_filename, chunks=chunks, shards=shards, 
+                              compressor=compressor, compression_level=compression_level, compute=False)
+    _, mean, std = da.compute(stored, data.mean(), data.std())
+    entry = {'ID': output_name,
+             'image_dims': [int(n) for n in data.shape],
+             'image_filename': image_filename,
+             'dtype': str(data.dtype),
+             'chunks': [int(c) for c in chunks],
+             'shards': [int(c) for c in shards] if shards is not None else None,
+             'intensity_range': [float(i) for i in intensity_range] if intensity_range is not None else None,
+             'intensity_mean': float(mean),
+             'intensity_std': float(std),
+             'label_filename': None}
     
     # Repeat of labels if present
     if labels is not None: 
         # Rechunk dask array and save as zarr
-        labels = labels.rechunk(chunks)
-        labels.to_zarr(os.path.join(output_path, str(output_name)+"_labels"))
+        label_filename = os.path.join(output_path, str(output_name)+"_labels")
+        label_chunks = chunks if label_chunks is None else label_chunks
+        label_shards = shards if label_shards is None else label_shards
+        write_zarr_array(labels, label_filename, dtype=label_dtype,
+                         chunks=label_chunks, shards=label_shards, 
+                         compressor=compressor if label_compressor is None else label_compressor, 
+                         compression_level=compression_level if label_compression_level is None else label_compression_level)
         
-        # Save data header for easy reading in
-        header = DataHeader(ID=output_name, image_dims=labels.shape, 
-                            image_filename=os.path.join(output_path, output_name),
-                            label_filename=os.path.join(output_path, str(output_name)+"_labels"))
-        header.save(header_name)
-    else:
-        # Save data header for easy reading in, with label_filename=None
-        header = DataHeader(ID=output_name, image_dims=data.shape, 
-                            image_filename=os.path.join(output_path, output_name),
-                            label_filename=None)
-        header.save(header_name)
+        # Foreground index and voxels of each class, from one read of the stored labels (cheaper than recomputing labels)
+        stored_labels = da.from_zarr(label_filename)
+        fractions, values, counts = da.compute(foreground_fractions(stored_labels, block=label_chunks), 
+                                               *da.unique(stored_labels, return_counts=True))
+        foreground_filename = os.path.join(output_path, str(output_name)+"_foreground")
+        index = write_zarr_array(da.from_array(fractions), foreground_filename, chunks=fractions.shape, overwrite=True)
+        index.attrs['block'] = [int(c) for c in label_chunks]
+        class_counts = np.zeros(int(values.max())+1, dtype=np.int64)
+        class_counts[values.astype(np.int64)] = counts
         
-    return output_path, header_name
+        entry.update({'label_filename': label_filename,
+                      'label_dtype': str(stored_labels.dtype),
+                      'label_chunks': [int(c) for c in label_chunks],
+                      'label_shards': [int(c) for c in label_shards] if label_shards is not None else None,
+                      'foreground_filename': foreground_filename,
+                      'class_counts': class_counts.tolist()})
+    
+    catalogue = update_catalogue(header_folder, entry)
+    return output_path, catalogue
+
+# Catalogue of preprocessed datasets, saved in each headers folder
+CATALOGUE_FILENAME = "catalogue.json"
+_catalogue_lock = threading.Lock() # Datasets may be saved from several threads (see preprocessing.py --workers)
+
+@contextlib.contextmanager
+def _locked_file(path, timeout=60., stale=60.):
+    # Lock shared by processes, held by creating path+".lock" (works on any OS and filesystem). Locks older than 
+    # stale seconds are left over from a process that was killed, as catalogue updates take milliseconds
+    lock_path = path+".lock"
+    start = time.time()
+    while True:
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except FileExistsError:
+            try:
+                if time.time()-os.path.getmtime(lock_path) > stale:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue # Released in the meantime
+            if time.time()-start > timeout:
+                raise TimeoutError("Could not lock {} - delete {} if no other process is using it".format(path, lock_path))
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.remove(lock_path)
+
+def update_catalogue(header_folder, entry):
+    """Adds a dataset to the catalogue (a JSON file) in header_folder, replacing any dataset with the same ID.
+    Each dataset is a dict of its ID, shape, paths, layout and statistics (see save_as_zarr_array), so that all 
+    datasets in a folder are loaded with one read. Returns the path of the catalogue.
+    The catalogue is locked while it is read and rewritten, so several threads or processes (e.g. preprocessing.py
+    runs sharing an output folder) can add datasets at the same time."""
+    path = os.path.join(header_folder, CATALOGUE_FILENAME)
+    with _catalogue_lock, _locked_file(path):
+        catalogue = {'version': 1, 'datasets': {}}
+        if os.path.isfile(path):
+            with open(path) as f:
+                catalogue = json.load(f)
+        catalogue['datasets'][str(entry['ID'])] = entry
+        # Write to a temporary file first, so the catalogue is never left half written
+        tmp_path = path+".tmp"+str(os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(catalogue, f, indent=2)
+        os.replace(tmp_path, path)
+    return path
+
+def load_catalogue(path):
+    """Datasets in a catalogue, as a list of dicts (see save_as_zarr_array) sorted by ID. path is a headers folder
+    or catalogue file."""
+    if os.path.isdir(path):
+        path = os.path.join(path, CATALOGUE_FILENAME)
+    with open(path) as f:
+        datasets = json.load(f)['datasets']
+    return [datasets[ID] for ID in sorted(datasets)]
+
+def load_headers(path):
+    """DataHeaders of the datasets in a headers folder (or catalogue file), sorted by ID. Datasets are read from 
+    the folder's catalogue, together with any pickled DataHeader files (<ID>_header) saved there by earlier 
+    versions and not in the catalogue. path can also be a single pickled header file."""
+    from tUbeNet_classes import DataHeader
+    if os.path.isfile(path) and not path.endswith(".json"):
+        folder, filenames = None, [path]
+    else:
+        folder = os.path.dirname(path) if path.endswith(".json") else path
+        filenames = [os.path.join(folder, f) for f in os.listdir(folder) 
+                     if f.endswith("_header") and os.path.isfile(os.path.join(folder, f))]
+    
+    headers = {}
+    if folder is not None and os.path.isfile(os.path.join(folder, CATALOGUE_FILENAME)):
+        for entry in load_catalogue(folder):
+            headers[entry['ID']] = DataHeader(ID=entry['ID'], image_dims=tuple(entry['image_dims']), 
+                                              image_filename=entry['image_filename'], 
+                                              label_filename=entry.get('label_filename'),
+                                              intensity_range=entry.get('intensity_range'),
+                                              foreground_filename=entry.get('foreground_filename'))
+    
+    import pickle
+    for filename in filenames:
+        with open(filename, "rb") as f:
+            header = pickle.load(f) # Unpickle DataHeader object
+        headers.setdefault(header.ID, header) # Catalogue entry kept for datasets saved again since
+    return [headers[ID] for ID in sorted(headers, key=str)]
+
+def catalogue_weights(path, n_classes=2):
+    """Class weights and dataset weighting for training, derived from the class voxel counts in a catalogue 
+    (see load_catalogue) without reading the data. Classes are weighted by inverse frequency across all datasets
+    (total voxels / (n_classes * voxels of the class)), and datasets by their number of labelled (non-background)
+    voxels, in the order of load_headers. Returns (None, None) if class counts are not recorded for every dataset
+    (e.g. unlabelled data, or header files from earlier versions)."""
+    folder = os.path.dirname(path) if path.endswith(".json") else path
+    entries = {entry['ID']: entry for entry in load_catalogue(folder)} if os.path.isfile(
+        os.path.join(folder, CATALOGUE_FILENAME)) else {}
+    counts = []
+    for header in load_headers(folder):
+        entry = entries.get(header.ID, {})
+        if entry.get('class_counts') is None:
+            return None, None
+        counts.append(np.pad(entry['class_counts'], (0, max(0, n_classes-len(entry['class_counts']))))[:n_classes])
+    counts = np.array(counts, dtype=np.float64)
+    
+    totals = counts.sum(axis=0)
+    class_weights = [float(counts.sum()/(n_classes*n)) if n > 0 else 0. for n in totals]
+    foreground = counts[:,1:].sum(axis=1)
+    dataset_weighting = (foreground/foreground.sum()).tolist() if foreground.sum() > 0 else None
+    return class_weights, dataset_weighting
+
+def benchmark_zarr_layouts(data, output_path, layouts, window=(64,64,64), n_windows=100, seed=0):
+    """Compares ways of storing data in zarr format. data is written with each layout (a dict of options for 
+    write_zarr_array, e.g. {'chunks': (64,64,64), 'shards': (256,256,256), 'compressor': 'blosc-zstd'}) to a
+    temporary array in output_path, then read back whole and as n_windows random windows (as in training).
+    Throughput is in MB/s of uncompressed data. The temporary arrays are deleted afterwards.
+    Returns a list of results, one dict per layout."""
+    data = np.asarray(data) # Time writing only, not the computation of data
+    n_mb = data.nbytes/1e6
+    rng = np.random.default_rng(seed)
+    corners = [[rng.integers(0, max(1, n-w+1)) for n, w in zip(data.shape, window)] for _ in range(n_windows)]
+    
+    results = []
+    for i, layout in enumerate(layouts):
+        path = os.path.join(output_path, "benchmark_{}.zarr".format(i))
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            start = time.perf_counter()
+            write_zarr_array(da.from_array(data, chunks=layout.get('shards') or layout.get('chunks', (64,64,64))), 
+                             path, overwrite=True, **layout)
+            write_time = time.perf_counter()-start
+            
+            files = [os.path.join(d, f) for d, _, fs in os.walk(path) for f in fs]
+            start = time.perf_counter()
+            da.from_zarr(path).compute()
+            read_time = time.perf_counter()-start
+            
+            array = zarr.open_array(path, mode='r')
+            start = time.perf_counter()
+            for z, x, y in corners:
+                array[z:z+window[0], x:x+window[1], y:y+window[2]]
+            window_time = time.perf_counter()-start
+            
+            results.append({'layout': layout,
+                            'files': len(files),
+                            'size_mb': sum(os.path.getsize(f) for f in files)/1e6,
+                            'write_mb_s': n_mb/write_time,
+                            'read_mb_s': n_mb/read_time,
+                            'windows_per_s': n_windows/window_time})
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+    
+    print("{:>8} {:>10} {:>10} {:>10} {:>10}  {}".format("Files", "Size (MB)", "Write MB/s", "Read MB/s", "Windows/s", "Layout"))
+    for r in results:
+        name = ", ".join("{}={}".format(k, v) for k, v in r['layout'].items())
+        print("{:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f}  {}".format(r['files'], r['size_mb'], r['write_mb_s'], 
+                                                                         r['read_mb_s'], r['windows_per_s'], name))
+    return results
 
 #---------------------------EVALUATION----------------------------------------------------------------------
 
 def roc_analysis(model, data_dir, volume_dims=(64,64,64), 
                  overlap=None, n_classes=2, ignore_background=True,
-                 output_path=None, prob_output=True): 
+                 output_path=None, prob_output=True, batch_size=1): 
     """"
     Plots ROC Curve and Precision-Recall Curve for paired ground truth labels 
     and non-thresholded predictions (e.g. softmax output).
@@ -435,6 +1749,7 @@ def roc_analysis(model, data_dir, volume_dims=(64,64,64),
     ignore_background - when true, metrics are no calculated for class 0
     ouput_path - location to save plots and predicted segmentation
     prob_output - if true, the softmax probabilities will be saved, as opposed to the labels, allowing for custom thresholding
+    batch_size - number of windows passed to the model at once during inference
     """
     optimal_thresholds = []
     recall = []
@@ -465,7 +1780,8 @@ def roc_analysis(model, data_dir, volume_dims=(64,64,64),
             volume_dims=volume_dims,   
             overlap=overlap,       
             n_classes=n_classes,
-            preview=False  
+            preview=False,
+            batch_size=batch_size
         )
         
         y_pred = da.array(y_pred)
@@ -9,10 +9,9 @@ Created on Fri Sep  5 09:56:27 2025
 #Import libraries
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' #Suppress info logs from tf 
-import pickle
 from model import tUbeNet
 import tUbeNet_functions as tube
-from tUbeNet_classes import DataDir
+from tUbeNet_classes import DataDir, TFLiteModel
 import argparse
 
 def main(args):
@@ -21,6 +20,7 @@ def main(args):
     volume_dims = args.volume_dims
     overlap = args.overlap
     n_classes = args.n_classes #TO DO expand to handel multi-class case
+    batch_size = args.batch_size
     
     prob_output = args.prob_output
     attention = args.attention
@@ -31,16 +31,8 @@ def main(args):
     
     #----------------------------------------------------------------------------------------------------------------------------------------------
     """ Create Data Directory"""
-    # Load data headers into a list
-    header_filenames=[f for f in os.listdir(data_headers) if os.path.isfile(os.path.join(data_headers, f))]
-    headers = []
-    try:
-        for file in header_filenames: #Iterate through header files
-            file=os.path.join(data_headers,file)
-            with open(file, "rb") as f:
-                data_header = pickle.load(f) # Unpickle DataHeader object
-            headers.append(data_header) # Add to list of headers
-    except IndexError: print("Unable to load data header files from {data_headers}") 
+    # Load data headers from the catalogue (or pickled header files from earlier versions)
+    headers = tube.load_headers(data_headers)
     
     # Create empty data directory    
     data_dir = DataDir([], image_dims=[], 
@@ -61,8 +53,16 @@ def main(args):
     """ Load Model """
     tubenet = tUbeNet(n_classes=n_classes, input_dims=volume_dims, attention=attention)
     
-    # Load exisiting model 
-    model = tubenet.load_weights(filename=model_path, loss='DICE BCE')
+    if model_path.endswith('.tflite'):
+        # Quantised CPU model exported with quantise.py
+        model = TFLiteModel(model_path)
+    else:
+        # Load exisiting model 
+        model = tubenet.load_weights(filename=model_path, loss='DICE BCE')
+        
+        # Optionally run inference through a compiled function
+        if args.compiled or args.jit_compile:
+            model = tubenet.inference_function(model, batch_size=batch_size, jit_compile=args.jit_compile)
     
     """ Plot ROC """
     # Evaluate model on data
@@ -71,7 +71,8 @@ def main(args):
                                           n_classes=n_classes, 
                                           overlap=overlap,
                                           output_path=output_path,
-                                          prob_output=prob_output) 
+                                          prob_output=prob_output,
+                                          batch_size=batch_size) 
 
 def parse_dims(values):
     """Parse volume dimensions: allow either one int (isotropic) or three ints (anisotropic)."""
@@ -90,7 +91,7 @@ if __name__ == "__main__":
     parser.add_argument("--data_headers", type=str, required=True,
                         help="Path to directory containing preprocessed header files.")
     parser.add_argument("--model_path", type=str, required=True,
-                        help="Path to trained model (.h5 file).")
+                        help="Path to trained model (.h5 file, or .tflite file exported with quantise.py).")
     parser.add_argument("--output_path", type=str, required=True,
                         help="Directory where predictions will be saved.")
 
@@ -101,6 +102,12 @@ if __name__ == "__main__":
                         help="Overlap between patches during inference. Provide 1 value (isotropic) "
                              "or 3 values (anisotropic). E.g. --overlap 32 OR --volume_dims 16 32 32. "
                              "Defaults to half of volume_dims.")
+    parser.add_argument("--batch_size", type=int, default=4,
+                        help="Number of patches passed to the model at once during inference.")
+    parser.add_argument("--compiled", action="store_true",
+                        help="Run inference through a compiled tf.function instead of model.predict.")
+    parser.add_argument("--jit_compile", action="store_true",
+                        help="Compile the inference function with XLA (implies --compiled).")
     parser.add_argument("--prob_output", action="store_true",
                         help="Save predictions as softmax probabilities.")
     parser.add_argument("--attention", action="store_true",
@@ -9,7 +9,6 @@ Created on Wed Sep  3 16:21:26 2025
 #Import libraries
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' #Suppress info logs from tf 
-import pickle
 import datetime
 import argparse
 from model import tUbeNet
@@ -53,22 +52,25 @@ def main(args):
     
     #----------------------------------------------------------------------------------------------------------------------------------------------
     """ Create Data Directory"""
-    # Load data headers into a list
-    header_filenames=[f for f in os.listdir(data_headers) if os.path.isfile(os.path.join(data_headers, f))]
-    headers = []
-    try:
-        for file in header_filenames: #Iterate through header files
-            file=os.path.join(data_headers,file)
-            with open(file, "rb") as f:
-                data_header = pickle.load(f) # Unpickle DataHeader object
-            headers.append(data_header) # Add to list of headers
-    except FileNotFoundError: print("Unable to load data header files from {data_headers}") 
+    # Load data headers from the catalogue (or pickled header files from earlier versions)
+    headers = tube.load_headers(data_headers)
+    
+    # Weights derived from the class voxel counts recorded in the catalogue (unless given)
+    if args.auto_weights:
+        auto_class_weights, auto_dataset_weighting = tube.catalogue_weights(data_headers, n_classes=n_classes)
+        if auto_class_weights is None:
+            print("No class counts recorded in {} - run preprocessing.py again to use --auto_weights".format(data_headers))
+        else:
+            if class_weights is None: class_weights = auto_class_weights
+            if dataset_weighting is None: dataset_weighting = auto_dataset_weighting
+            print("Class weights: {}, dataset weighting: {}".format(class_weights, dataset_weighting))
     
     # Create empty data directory    
     data_dir = DataDir([], image_dims=[], 
                        image_filenames=[], 
                        label_filenames=[], 
-                       data_type=[], exclude_region=[])
+                       data_type=[], exclude_region=[],
+                       foreground_filenames=[])
     
     # Fill directory from headers
     for header in headers:
@@ -76,6 +78,7 @@ def main(args):
         data_dir.image_dims.append(header.image_dims)
         data_dir.image_filenames.append(header.image_filename)
         data_dir.label_filenames.append(header.label_filename)
+        data_dir.foreground_filenames.append(getattr(header, 'foreground_filename', None)) # Headers from older versions have no index
         data_dir.data_type.append('float32')
         data_dir.exclude_region.append((None,None,None)) #region to be left out of training for use as validation data (under development)
 
@@ -136,22 +139,15 @@ def main(args):
         
     # Create directory of validation data
     if val_headers is not None:
-        # Import data header
-        header_filenames=[f for f in os.listdir(val_headers) if os.path.isfile(os.path.join(val_headers, f))]
-        headers = []
-        try:
-            for file in header_filenames: #Iterate through header files
-                file=os.path.join(val_headers,file)
-                with open(file, "rb") as f:
-                    val_header = pickle.load(f) # Unpickle DataHeader object
-                headers.append(val_header) # Add to list of headers
-        except FileNotFoundError: print("Unable to load data header files from {val_headers}") 
+        # Load data headers from the catalogue (or pickled header files from earlier versions)
+        headers = tube.load_headers(val_headers)
             
         # Create empty data directory    
         val_dir = DataDir([], image_dims=[], 
                            image_filenames=[], 
                            label_filenames=[], 
-                           data_type=[], exclude_region=[])
+                           data_type=[], exclude_region=[],
+                           foreground_filenames=[])
         
         # Fill directory from headers
         for header in headers:
@@ -159,6 +155,7 @@ def main(args):
             val_dir.image_dims.append(header.image_dims)
             val_dir.image_filenames.append(header.image_filename)
             val_dir.label_filenames.append(header.label_filename)
+            val_dir.foreground_filenames.append(getattr(header, 'foreground_filename', None)) # Headers from older versions have no index
             val_dir.data_type.append('float32')
             val_dir.exclude_region.append((None,None,None))
        
@@ -239,6 +236,9 @@ if __name__ == "__main__":
                         help="Initial learning rate.")
     parser.add_argument("--class_weights", type=float, nargs='+', default=None,
                         help="Relative class weights given as a list (e.g. background, vessels -> (0, 1)).")
+    parser.add_argument("--auto_weights", action="store_true",
+                        help="Derive class weights (inverse class frequency) and dataset weighting (number of vessel "
+                        "voxels) from the data catalogue, unless given with --class_weights/--dataset_weighting.")
     parser.add_argument("--n_classes", type=int, default=2,
                         help="Number of classes to predict. Ensure this is the same for all data included in training.")
     parser.add_argument("--no_augment", action="store_false",
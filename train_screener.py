@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Trains a small screening network from existing labels, for two-stage (cascade) inference: windows the
+screener scores as empty are not passed to the full tUbeNet model (see predict.py --screener_path).
+"""
+
+#Import libraries
+import os
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '1' #Suppress info logs from tf
+import datetime
+import argparse
+from model import tUbeNet
+import tUbeNet_functions as tube
+from tUbeNet_classes import DataDir, DataGenerator, ScreeningGenerator
+from tensorflow.keras.callbacks import ModelCheckpoint
+from tensorflow.keras.optimizers import Adam
+
+def load_data_dir(data_headers):
+    """Create data directory from the header files in data_headers"""
+    # Load data headers from the catalogue (or pickled header files from earlier versions)
+    headers = tube.load_headers(data_headers)
+
+    # Create empty data directory
+    data_dir = DataDir([], image_dims=[],
+                       image_filenames=[],
+                       label_filenames=[],
+                       data_type=[], exclude_region=[])
+
+    # Fill directory from headers
+    for header in headers:
+        data_dir.list_IDs.append(header.ID)
+        data_dir.image_dims.append(header.image_dims)
+        data_dir.image_filenames.append(header.image_filename)
+        data_dir.label_filenames.append(header.label_filename)
+        data_dir.data_type.append('float32')
+        data_dir.exclude_region.append((None,None,None))
+    return data_dir
+
+def main(args):
+    """Set parameters and file paths:"""
+    # Paramters
+    volume_dims = args.volume_dims
+    batch_size = args.batch_size
+    n_classes = args.n_classes
+    model_path = args.model_path
+
+    #----------------------------------------------------------------------------------------------------------------------------------------------
+    """ Create Data Generators """
+    # Windows are drawn without a preference for vessels (vessel_threshold=-1), so that empty windows
+    # are seen as often as they occur in the data
+    params = {'batch_size': batch_size,
+              'volume_dims': volume_dims,
+              'n_classes': n_classes,
+              'dataset_weighting': args.dataset_weighting,
+              'vessel_threshold': -1,
+              'shuffle': False}
+    data_dir = load_data_dir(args.data_headers)
+    data_generator = ScreeningGenerator(DataGenerator(data_dir, augment=args.no_augment, **params),
+                                        min_voxels=args.min_voxels)
+
+    if args.val_headers is not None:
+        val_dir = load_data_dir(args.val_headers)
+    else:
+        print("No validation data provided - screening report will use the training data")
+        val_dir = data_dir
+    val_generator = DataGenerator(val_dir, augment=False, **params)
+
+    """ Build and train screener """
+    screener = tUbeNet(n_classes=n_classes, input_dims=volume_dims).build_screener()
+    screener.compile(optimizer=Adam(learning_rate=args.lr0), loss='categorical_crossentropy', metrics=['accuracy'])
+    screener.summary()
+
+    date = datetime.datetime.now()
+    filepath = os.path.join(model_path, "{}_screener.weights.h5".format(date.strftime("%d%m%y")))
+    checkpoint = ModelCheckpoint(filepath, monitor='loss', verbose=1, save_weights_only=True, save_best_only=True, mode='min')
+    screener.fit(data_generator, epochs=args.n_epochs, steps_per_epoch=args.steps_per_epoch, callbacks=[checkpoint])
+    screener.save_weights(filepath)
+    print("Saved screening network to {}".format(filepath))
+
+    """ Report recall lost vs. time saved """
+    # Both networks are run through compiled inference functions, as during inference
+    tubenet = tUbeNet(n_classes=n_classes, input_dims=volume_dims, attention=args.attention)
+    model = None
+    if args.model_weights_file is not None:
+        model = tubenet.load_weights(filename=args.model_weights_file, loss='DICE CE')
+        model = tubenet.inference_function(model, batch_size=batch_size)
+    tube.screening_report(tubenet.inference_function(screener, batch_size=batch_size), val_generator, 
+                          model=model, n_batches=args.n_report_batches)
+
+def parse_dims(values):
+    """Parse volume dimensions: allow either one int (isotropic) or three ints (anisotropic)."""
+    if len(values) == 1:
+        return (values[0], values[0], values[0])
+    elif len(values) == 3:
+        return tuple(values)
+    else:
+        raise argparse.ArgumentTypeError(
+            "volume_dims must be either a single value (e.g. --volume_dims 64) "
+            "or three values (e.g. --volume_dims 64 64 32).")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train screening network for cascade inference with TubeNet.")
+
+    # Data paths
+    parser.add_argument("--data_headers", type=str, required=True,
+                        help="Path to directory containing training header files.")
+    parser.add_argument("--val_headers", type=str, default=None,
+                        help="Path to directory containing validation header files, used for the screening report (optional).")
+    parser.add_argument("--model_path", type=str, required=True,
+                        help="Directory where the trained screening network will be saved.")
+    parser.add_argument("--model_weights_file", type=str, default=None,
+                        help="Trained tUbeNet weights (optional). If given, the time saved by screening is estimated "
+                             "by timing both networks.")
+
+    # Parameters
+    parser.add_argument("--volume_dims", type=int, nargs="+", default=[64, 64, 64],
+                        help="Volume dimensions of training windows. Provide 1 value (isotropic) or 3 values (anisotropic). "
+                             "Use the window size used for inference.")
+    parser.add_argument("--min_voxels", type=int, default=1,
+                        help="Minimum number of labelled vessel voxels for a window to count as containing vessels.")
+    parser.add_argument("--n_epochs", type=int, default=20,
+                        help="Number of epochs for training.")
+    parser.add_argument("--steps_per_epoch", type=int, default=100,
+                        help="Number of batches generated per epoch.")
+    parser.add_argument("--batch_size", type=int, default=8,
+                        help="Batch size.")
+    parser.add_argument("--dataset_weighting", type=float, nargs="+", default=None,
+                        help="Relative weighting when pulling training data from multiple datasets.")
+    parser.add_argument("--lr0", type=float, default=1e-3,
+                        help="Initial learning rate.")
+    parser.add_argument("--n_classes", type=int, default=2,
+                        help="Number of classes in the labels (all foreground classes count as vessels).")
+    parser.add_argument("--no_augment", action="store_false",
+                        help="Disable data augmentation.")
+    parser.add_argument("--attention", action="store_true",
+                        help="Use this flag if --model_weights_file is a tubenet model built with attention blocks")
+    parser.add_argument("--n_report_batches", type=int, default=20,
+                        help="Number of batches of windows used for the screening report.")
+
+    args = parser.parse_args()
+    args.volume_dims = parse_dims(args.volume_dims)
+    main(args)